@@ -2,10 +2,18 @@
 # PDF Consultor - Chat Service
 # ==========================================
 
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple, Sequence, AsyncIterator
+from collections import deque, OrderedDict
+from functools import lru_cache
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+import time
 import tiktoken
 
-from openai import OpenAI
+from openai import AsyncOpenAI
 
 from app.config import settings
 from app.models import ChatMessage, ChatResponse
@@ -13,12 +21,63 @@ from app.rag_service import rag_service
 from app.raptor_service import raptor_service
 
 
+logger = logging.getLogger(__name__)
+
+
+# Prompt de sistema do chat
+CHAT_SYSTEM_PROMPT = "Você é um assistente especializado em responder perguntas sobre documentos."
+
+# Prompt de sistema do resumo
+SUMMARY_SYSTEM_PROMPT = "Você é um assistente especializado em resumir documentos de forma clara e estruturada."
+
+# Cabeçalho fixo do prompt de chat
+CHAT_PROMPT_HEADER = (
+    "Você é um assistente especializado em responder perguntas sobre documentos PDF.\n"
+    "Você deve responder baseando-se APENAS no contexto fornecido abaixo.\n"
+    "Se a informação não estiver no contexto, diga que não encontrou a resposta.\n"
+    "Seja claro, conciso e cite a página das informações quando possível.\n"
+    "\n"
+    "CONTEXTO DO DOCUMENTO:"
+)
+
+
+# Número máximo de mensagens do histórico enviadas ao LLM
+MAX_HISTORY_MESSAGES = 10
+
+# Número máximo de respostas de chat mantidas em cache
+RESPONSE_CACHE_SIZE = 128
+
+
+def _prompt_cache_body(cache_key: Optional[str]) -> Optional[Dict[str, str]]:
+    """
+    Parâmetros extras da requisição para o cache de prompt do provedor
+
+    O OpenAI reaproveita prefixos de prompt já processados; a chave faz
+    requisições do mesmo documento caírem no mesmo cache.
+    """
+    return {"prompt_cache_key": cache_key} if cache_key else None
+
+
+@lru_cache(maxsize=4)
+def _get_encoding(model: str) -> tiktoken.Encoding:
+    """Retorna o tokenizer do modelo (carregado uma única vez por processo)"""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
 class ChatService:
     """Serviço de chat com RAG e RAPTOR"""
 
     def __init__(self):
         self.llm_client = None
-        self.encoding = None
+        self.encoding = _get_encoding(settings.openai_model)
+        self._inflight: Dict[Tuple[str, str, int], asyncio.Future] = {}
+        self._llm_semaphore = asyncio.Semaphore(settings.max_concurrent_requests)
+        self._response_cache = OrderedDict()  # (doc, hash da conversa, raptor) -> (timestamp, resposta)
+        self._response_cache_lock = threading.Lock()
+        self._generations: Dict[str, int] = {}  # doc -> nº de invalidações (descarta respostas em andamento)
         self.initialized = False
 
     def initialize(self):
@@ -26,26 +85,23 @@ class ChatService:
         if self.initialized:
             return
 
-        print(f"Inicializando Chat Service...")
+        logger.info("Inicializando Chat Service...")
 
         # Inicializar cliente OpenAI
         if settings.openai_api_key:
-            self.llm_client = OpenAI(api_key=settings.openai_api_key)
+            self.llm_client = AsyncOpenAI(api_key=settings.openai_api_key)
         else:
-            print("  AVISO: OPENAI_API_KEY não configurada.")
-
-        # Inicializar tokenizer
-        self.encoding = tiktoken.encoding_for_model(settings.openai_model)
+            logger.warning("OPENAI_API_KEY não configurada.")
 
         self.initialized = True
-        print("Chat Service inicializado!")
+        logger.info("Chat Service inicializado!")
 
     def count_tokens(self, text: str) -> int:
         """Conta tokens em um texto"""
-        if not self.encoding:
-            self.encoding = tiktoken.encoding_for_model(settings.openai_model)
+        if not text:
+            return 0
 
-        return len(self.encoding.encode(text))
+        return len(self.encoding.encode_ordinary(text))
 
     def build_context(self, query: str, chunks: List[Dict[str, Any]],
                      use_raptor: bool, raptor_tree: Optional[Dict[str, Any]] = None) -> str:
@@ -61,39 +117,60 @@ class ChatService:
         Returns:
             Contexto formatado para o LLM
         """
-        context_parts = []
+        raptor_summary = None
 
         # Se usar RAPTOR, adicionar resumo do nível mais alto
         if use_raptor and raptor_tree:
             raptor_summary = raptor_service.get_raptor_summary(raptor_tree, level=-1)
 
-            if raptor_summary:
-                context_parts.append(f"RESUMO EXECUTIVO DO DOCUMENTO:\n{raptor_summary}\n")
+        # Pré-alocar as partes: [resumo] + cabeçalho + um trecho por chunk
+        offset = 2 if raptor_summary else 1
+        context_parts = [None] * (offset + len(chunks))
+
+        if raptor_summary:
+            context_parts[0] = f"RESUMO EXECUTIVO DO DOCUMENTO:\n{raptor_summary}\n"
 
         # Adicionar chunks relevantes
-        context_parts.append("TRECHOS RELEVANTES:\n")
+        context_parts[offset - 1] = "TRECHOS RELEVANTES:\n"
 
         for i, chunk in enumerate(chunks):
             page = chunk["metadata"].get("page", "N/A")
-            context_parts.append(f"\n[Trecho {i+1} - Página {page}]:")
-            context_parts.append(chunk["text"])
+            context_parts[offset + i] = f"\n[Trecho {i+1} - Página {page}]:\n{chunk['text']}"
+
+        # Estimativa barata (~4 caracteres/token) antes de tokenizar de fato
+        approx_tokens = sum(len(part) for part in context_parts) >> 2
+
+        if approx_tokens > settings.max_context_tokens * 0.9:
+            # Tokenizar todas as partes em lote (uma única chamada ao tokenizer)
+            encoded_parts = self.encoding.encode_ordinary_batch(context_parts, num_threads=4)
+
+            # +1 por parte para o separador "\n" da junção
+            if sum(len(tokens) for tokens in encoded_parts) + len(context_parts) > settings.max_context_tokens:
+                available_tokens = settings.max_context_tokens - 500  # Reservar espaço para prompt
 
-        # Controlar tamanho do contexto
-        full_context = "\n".join(context_parts)
+                # Manter as partes iniciais enquanto couberem no orçamento
+                used_tokens = 0
+                keep = 0
+                for tokens in encoded_parts:
+                    if used_tokens + len(tokens) + 1 > available_tokens:
+                        break
+                    used_tokens += len(tokens) + 1
+                    keep += 1
 
-        if self.count_tokens(full_context) > settings.max_context_tokens:
-            # Truncar se necessário
-            available_tokens = settings.max_context_tokens - 500  # Reservar espaço para prompt
+                truncated_parts = context_parts[:keep]
 
-            # Estimar caracteres por token (aproximadamente 4)
-            max_chars = available_tokens * 4
+                # Cortar a parte que ultrapassa o limite no nível de tokens
+                remaining_tokens = available_tokens - used_tokens - 1
+                if remaining_tokens > 0:
+                    truncated_parts.append(self.encoding.decode(encoded_parts[keep][:remaining_tokens]))
 
-            full_context = full_context[:max_chars]
-            full_context += "\n\n[Contexto truncado devido ao limite de tokens]"
+                truncated_parts.append("\n[Contexto truncado devido ao limite de tokens]")
+                context_parts = truncated_parts
 
-        return full_context
+        return "\n".join(context_parts)
 
-    def build_prompt(self, query: str, context: str, history: List[ChatMessage]) -> str:
+    def build_prompt(self, query: str, context: str,
+                     history: Optional[Sequence[ChatMessage]] = None) -> str:
         """
         Constrói o prompt para o LLM
 
@@ -105,33 +182,103 @@ class ChatService:
         Returns:
             Prompt formatado
         """
-        prompt_parts = [
-            "Você é um assistente especializado em responder perguntas sobre documentos PDF.",
-            "Você deve responder baseando-se APENAS no contexto fornecido abaixo.",
-            "Se a informação não estiver no contexto, diga que não encontrou a resposta.",
-            "Seja claro, conciso e cite a página das informações quando possível.",
-            "",
-            "CONTEXTO DO DOCUMENTO:",
-            context,
-            "",
-            "HISTÓRICO DE CONVERSA:",
-        ]
+        if not isinstance(history, deque):
+            history = deque(history or (), maxlen=MAX_HISTORY_MESSAGES)
 
         # Adicionar histórico (últimas 5 trocas)
-        for msg in history[-10:]:
-            role = "USUÁRIO" if msg.role == "user" else "ASSISTENTE"
-            prompt_parts.append(f"{role}: {msg.content}")
+        history_block = "".join(
+            f"{'USUÁRIO' if msg.role == 'user' else 'ASSISTENTE'}: {msg.content}\n"
+            for msg in history
+        )
+
+        return (
+            f"{CHAT_PROMPT_HEADER}\n{context}\n\n"
+            f"HISTÓRICO DE CONVERSA:\n{history_block}"
+            f"\nPERGUNTA ATUAL:\n{query}\n"
+            "\nRESPOSTA:"
+        )
+
+    async def _complete(self, system_prompt: str, user_prompt: str, max_tokens: int,
+                        cache_key: Optional[str] = None) -> str:
+        """
+        Executa uma chamada ao LLM de forma assíncrona
+
+        Requisições idênticas em andamento são agrupadas: apenas uma chamada
+        é feita à API e todas as requisições concorrentes recebem o mesmo
+        resultado. cache_key (o ID do documento) agrupa no provedor as
+        requisições que compartilham o mesmo prefixo de prompt.
+        """
+        key = (system_prompt, user_prompt, max_tokens)
+
+        pending = self._inflight.get(key)
+        if pending is None:
+            pending = asyncio.ensure_future(
+                self._request_completion(system_prompt, user_prompt, max_tokens, cache_key)
+            )
+            self._inflight[key] = pending
+            pending.add_done_callback(lambda _: self._inflight.pop(key, None))
+
+        return await asyncio.shield(pending)
+
+    async def _request_completion(self, system_prompt: str, user_prompt: str, max_tokens: int,
+                                  cache_key: Optional[str] = None) -> str:
+        """Envia a requisição ao LLM respeitando o limite de concorrência"""
+        async with self._llm_semaphore:
+            response = await self.llm_client.chat.completions.create(
+                model=settings.openai_model,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_prompt}
+                ],
+                temperature=0.3,
+                max_tokens=max_tokens,
+                extra_body=_prompt_cache_body(cache_key)
+            )
+
+        return response.choices[0].message.content.strip()
+
+    async def _retrieve(self, query: str, document_id: str,
+                        use_raptor: bool) -> Tuple[List[Dict[str, Any]], Optional[Dict[str, Any]]]:
+        """Executa a busca RAG e o carregamento da árvore RAPTOR em paralelo"""
+        rag_task = asyncio.to_thread(
+            rag_service.hybrid_search,
+            query=query,
+            top_k=settings.top_k_results,
+            document_id=document_id
+        )
+
+        if not use_raptor:
+            return await rag_task, None
 
-        prompt_parts.append(f"\nPERGUNTA ATUAL:\n{query}")
-        prompt_parts.append("\nRESPOSTA:")
+        tree_task = asyncio.to_thread(raptor_service.load_raptor_tree, document_id)
 
-        return "\n".join(prompt_parts)
+        rag_results, raptor_tree = await asyncio.gather(rag_task, tree_task)
+        return rag_results, raptor_tree
 
-    def chat(self, query: str, document_id: str, history: List[ChatMessage] = [],
+    def _response_cache_key(self, query: str, document_id: str, history: Sequence[ChatMessage],
+                            use_raptor: bool) -> Tuple[str, str, bool]:
+        """Chave do cache de respostas: documento, pergunta + histórico recente e modo RAPTOR"""
+        digest = hashlib.sha1(query.encode("utf-8"))
+        for msg in history:
+            digest.update(f"\0{msg.role}\0{msg.content}".encode("utf-8"))
+
+        return (document_id, digest.hexdigest(), use_raptor)
+
+    def invalidate_document(self, document_id: str):
+        """Remove do cache as respostas sobre um documento alterado"""
+        with self._response_cache_lock:
+            self._generations[document_id] = self._generations.get(document_id, 0) + 1
+            for key in [k for k in self._response_cache if k[0] == document_id]:
+                del self._response_cache[key]
+
+    async def chat(self, query: str, document_id: str, history: Optional[Sequence[ChatMessage]] = None,
               use_raptor: bool = True) -> ChatResponse:
         """
         Gera resposta para uma query usando RAG
 
+        Respostas bem-sucedidas ficam em cache (LRU com TTL) até o documento
+        ser reindexado ou excluído.
+
         Args:
             query: Query do usuário
             document_id: ID do documento
@@ -141,15 +288,22 @@ class ChatService:
         Returns:
             Resposta do chat com fontes
         """
+        history = deque(history or (), maxlen=MAX_HISTORY_MESSAGES)
+
         if not self.initialized:
             self.initialize()
 
-        # 1. Recuperar chunks via RAG
-        rag_results = rag_service.hybrid_search(
-            query=query,
-            top_k=settings.top_k_results,
-            document_id=document_id
-        )
+        cache_key = self._response_cache_key(query, document_id, history, use_raptor)
+
+        with self._response_cache_lock:
+            cached = self._response_cache.get(cache_key)
+            if cached and time.monotonic() - cached[0] < settings.cache_ttl:
+                self._response_cache.move_to_end(cache_key)
+                return cached[1].model_copy(deep=True)
+            generation = self._generations.get(document_id, 0)
+
+        # 1. Recuperar chunks via RAG (e árvore RAPTOR, em paralelo)
+        rag_results, raptor_tree = await self._retrieve(query, document_id, use_raptor)
 
         if not rag_results:
             return ChatResponse(
@@ -158,15 +312,11 @@ class ChatService:
                 model=settings.openai_model
             )
 
-        # 2. Se usando RAPTOR, carregar árvore e recuperar resumo
+        # 2. Se usando RAPTOR, recuperar resumo
         raptor_summary = None
-        raptor_tree = None
-
-        if use_raptor:
-            raptor_tree = raptor_service.load_raptor_tree(document_id)
 
-            if raptor_tree:
-                raptor_summary = raptor_service.get_raptor_summary(raptor_tree)
+        if raptor_tree:
+            raptor_summary = raptor_service.get_raptor_summary(raptor_tree)
 
         # 3. Construir contexto
         context = self.build_context(
@@ -181,39 +331,148 @@ class ChatService:
 
         # 5. Gerar resposta
         try:
-            response = self.llm_client.chat.completions.create(
-                model=settings.openai_model,
-                messages=[
-                    {"role": "system", "content": "Você é um assistente especializado em responder perguntas sobre documentos."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.3,
-                max_tokens=2000
+            answer = await self._complete(
+                system_prompt=CHAT_SYSTEM_PROMPT,
+                user_prompt=prompt,
+                max_tokens=2000,
+                cache_key=document_id
             )
 
-            answer = response.choices[0].message.content.strip()
-
         except Exception as e:
-            print(f"Erro ao gerar resposta: {e}")
-            answer = f"Erro ao processar sua pergunta: {str(e)}"
+            logger.error("Erro ao gerar resposta: %s", e)
+            return ChatResponse(
+                answer=f"Erro ao processar sua pergunta: {str(e)}",
+                sources=self._build_sources(rag_results),
+                raptor_summary=raptor_summary,
+                model=settings.openai_model
+            )
 
         # 6. Preparar fontes
+        sources = self._build_sources(rag_results)
+
+        response = ChatResponse(
+            answer=answer,
+            sources=sources,
+            raptor_summary=raptor_summary,
+            model=settings.openai_model
+        )
+
+        with self._response_cache_lock:
+            # Documento invalidado durante a geração: a resposta pode vir do índice antigo
+            if self._generations.get(document_id, 0) == generation:
+                self._response_cache[cache_key] = (time.monotonic(), response)
+                self._response_cache.move_to_end(cache_key)
+                while len(self._response_cache) > RESPONSE_CACHE_SIZE:
+                    self._response_cache.popitem(last=False)
+
+        return response.model_copy(deep=True)
+
+    async def chat_stream(self, query: str, document_id: str,
+                          history: Optional[Sequence[ChatMessage]] = None,
+                          use_raptor: bool = True) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Gera resposta para uma query usando RAG, emitindo tokens à medida que chegam
+
+        Emite eventos {"type": "token", "content": ...} durante a geração e,
+        ao final, um evento {"type": "done", ...} com fontes e resumo RAPTOR.
+
+        Args:
+            query: Query do usuário
+            document_id: ID do documento
+            history: Histórico de conversa
+            use_raptor: Se deve usar RAPTOR
+        """
+        history = deque(history or (), maxlen=MAX_HISTORY_MESSAGES)
+
+        if not self.initialized:
+            self.initialize()
+
+        # 1. Recuperar chunks via RAG (e árvore RAPTOR, em paralelo)
+        rag_results, raptor_tree = await self._retrieve(query, document_id, use_raptor)
+
+        if not rag_results:
+            yield {"type": "token", "content": "Desculpe, não encontrei informações relevantes no documento."}
+            yield {"type": "done", "sources": [], "raptor_summary": None, "model": settings.openai_model}
+            return
+
+        # 2. Se usando RAPTOR, recuperar resumo
+        raptor_summary = None
+
+        if raptor_tree:
+            raptor_summary = raptor_service.get_raptor_summary(raptor_tree)
+
+        # 3. Construir contexto e prompt
+        context = self.build_context(
+            query=query,
+            chunks=rag_results,
+            use_raptor=use_raptor,
+            raptor_tree=raptor_tree
+        )
+        prompt = self.build_prompt(query, context, history)
+
+        # 4. Gerar resposta em streaming
+        try:
+            async with self._llm_semaphore:
+                stream = await self.llm_client.chat.completions.create(
+                    model=settings.openai_model,
+                    messages=[
+                        {"role": "system", "content": CHAT_SYSTEM_PROMPT},
+                        {"role": "user", "content": prompt}
+                    ],
+                    temperature=0.3,
+                    max_tokens=2000,
+                    stream=True,
+                    extra_body=_prompt_cache_body(document_id)
+                )
+
+                async for chunk in stream:
+                    if not chunk.choices:
+                        continue
+
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        yield {"type": "token", "content": delta}
+
+        except Exception as e:
+            logger.error("Erro ao gerar resposta: %s", e)
+            yield {"type": "error", "content": f"Erro ao processar sua pergunta: {str(e)}"}
+
+        # 5. Enviar fontes ao final
+        yield {
+            "type": "done",
+            "sources": self._build_sources(rag_results),
+            "raptor_summary": raptor_summary,
+            "model": settings.openai_model
+        }
+
+    @staticmethod
+    def _build_sources(rag_results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Prepara a lista de fontes a partir dos chunks recuperados"""
         sources = []
         for chunk in rag_results:
+            text = chunk["text"]
             sources.append({
                 "page": chunk["metadata"].get("page", "N/A"),
                 "score": chunk["score"],
-                "snippet": chunk["text"][:200] + "..." if len(chunk["text"]) > 200 else chunk["text"]
+                "snippet": text if len(text) <= 200 else text[:200] + "..."
             })
 
-        return ChatResponse(
-            answer=answer,
-            sources=sources,
-            raptor_summary=raptor_summary,
-            model=settings.openai_model
-        )
+        return sources
 
-    def summarize_document(self, document_id: str, pages: Optional[List[int]] = None,
+    def _fit_chunks_to_budget(self, chunks: List[Dict[str, Any]], max_tokens: int) -> List[Dict[str, Any]]:
+        """Mantém os chunks iniciais cujo total de tokens cabe no orçamento"""
+        texts = [chunk["text"] for chunk in chunks]
+        encoded = self.encoding.encode_ordinary_batch(texts, num_threads=os.cpu_count() or 1)
+
+        used_tokens = 0
+        for i, tokens in enumerate(encoded):
+            used_tokens += len(tokens)
+            if used_tokens > max_tokens:
+                return chunks[:max(i, 1)]
+
+        return chunks
+
+    async def summarize_document(self, document_id: str, pages: Optional[List[int]] = None,
                         detail_level: str = "medium") -> str:
         """
         Gera um resumo do documento
@@ -229,8 +488,8 @@ class ChatService:
         if not self.initialized:
             self.initialize()
 
-        # 1. Carregar árvore RAPTOR
-        raptor_tree = raptor_service.load_raptor_tree(document_id)
+        # 1. Carregar árvore RAPTOR (leitura de disco: fora do event loop)
+        raptor_tree = await asyncio.to_thread(raptor_service.load_raptor_tree, document_id)
 
         if raptor_tree:
             # 2. Usar resumo do RAPTOR
@@ -249,7 +508,7 @@ class ChatService:
                 return summary
 
         # 3. Se não tem RAPTOR, usar chunks
-        chunks = rag_service.get_document_chunks(document_id)
+        chunks = await asyncio.to_thread(rag_service.get_document_chunks, document_id)
 
         if not chunks:
             return "Não foi possível gerar um resumo. Documento não indexado."
@@ -263,6 +522,11 @@ class ChatService:
         if not filtered_chunks:
             filtered_chunks = chunks[:10]  # Usar primeiros 10 chunks
 
+        # Limitar ao orçamento de tokens (reservando espaço para o prompt)
+        filtered_chunks = await asyncio.to_thread(
+            self._fit_chunks_to_budget, filtered_chunks, settings.max_context_tokens - 1500
+        )
+
         # Concatenar chunks
         combined_text = "\n\n".join([chunk["text"] for chunk in filtered_chunks])
 
@@ -273,27 +537,26 @@ class ChatService:
             "detailed": "um resumo completo e abrangente"
         }
 
-        prompt = f"""Resuma o seguinte documento de forma {detail_prompt.get(detail_level, 'detalhada')}:
+        # Conteúdo do documento antes da instrução: o prefixo do prompt fica
+        # igual entre níveis de detalhe e pode ser reaproveitado pelo provedor
+        prompt = f"""DOCUMENTO:
 
 {combined_text}
 
+Resuma o documento acima de forma {detail_prompt.get(detail_level, 'detalhada')}.
+
 RESUMO:"""
 
         try:
-            response = self.llm_client.chat.completions.create(
-                model=settings.openai_model,
-                messages=[
-                    {"role": "system", "content": "Você é um assistente especializado em resumir documentos de forma clara e estruturada."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.3,
-                max_tokens=1500
+            return await self._complete(
+                system_prompt=SUMMARY_SYSTEM_PROMPT,
+                user_prompt=prompt,
+                max_tokens=1500,
+                cache_key=document_id
             )
 
-            return response.choices[0].message.content.strip()
-
         except Exception as e:
-            print(f"Erro ao gerar resumo: {e}")
+            logger.error("Erro ao gerar resumo: %s", e)
             return combined_text[:500] + "..."
 
 
@@ -2,25 +2,66 @@
 # PDF Consultor - Chat Service (Atualizado com PromptManager)
 # ==========================================
 
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple, Sequence, Mapping
+from collections import deque
+from functools import lru_cache
+from types import MappingProxyType
+import asyncio
+import logging
+import os
 import tiktoken
 
-from openai import OpenAI
+from openai import AsyncOpenAI
 
 from app.config import settings
 from app.models import ChatMessage, ChatResponse, DocumentCategory
 from app.rag_service import rag_service
 from app.raptor_service import raptor_service
-from app.prompts import PromptManager, DocType, DetailLevel
+from app.prompts import prompt_manager, DocType, DetailLevel
+
+
+logger = logging.getLogger(__name__)
+
+
+# Número máximo de mensagens do histórico enviadas ao LLM
+MAX_HISTORY_MESSAGES = 10
+
+
+def _prompt_cache_body(cache_key: Optional[str]) -> Optional[Dict[str, str]]:
+    """
+    Parâmetros extras da requisição para o cache de prompt do provedor
+
+    O OpenAI reaproveita prefixos de prompt já processados; a chave faz
+    requisições do mesmo documento caírem no mesmo cache.
+    """
+    return {"prompt_cache_key": cache_key} if cache_key else None
+
+
+@lru_cache(maxsize=4)
+def _get_encoding(model: str) -> tiktoken.Encoding:
+    """Retorna o tokenizer do modelo (carregado uma única vez por processo)"""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
 
 
 class ChatService:
     """Serviço de chat com RAG, RAPTOR e prompts aprimorados"""
 
+    # Mapeamento de categoria do documento para tipo de prompt
+    _CATEGORY_MAP: Mapping[DocumentCategory, DocType] = MappingProxyType({
+        DocumentCategory.JURIDICO: DocType.JURIDICO,
+        DocumentCategory.FINANCEIRO: DocType.FINANCEIRO,
+        DocumentCategory.TECNICO: DocType.TECNICO
+    })
+
     def __init__(self):
         self.llm_client = None
-        self.encoding = None
-        self.prompt_manager = PromptManager()
+        self.encoding = _get_encoding(settings.openai_model)
+        self.prompt_manager = prompt_manager
+        self._inflight: Dict[Tuple[str, str, int], asyncio.Future] = {}
+        self._llm_semaphore = asyncio.Semaphore(settings.max_concurrent_requests)
         self.initialized = False
 
     def initialize(self):
@@ -28,35 +69,27 @@ class ChatService:
         if self.initialized:
             return
 
-        print(f"Inicializando Chat Service...")
+        logger.info("Inicializando Chat Service...")
 
         # Inicializar cliente OpenAI
         if settings.openai_api_key:
-            self.llm_client = OpenAI(api_key=settings.openai_api_key)
+            self.llm_client = AsyncOpenAI(api_key=settings.openai_api_key)
         else:
-            print("  AVISO: OPENAI_API_KEY não configurada. Chat não funcionará.")
-
-        # Inicializar tokenizer
-        self.encoding = tiktoken.encoding_for_model(settings.openai_model)
+            logger.warning("OPENAI_API_KEY não configurada. Chat não funcionará.")
 
         self.initialized = True
-        print("Chat Service inicializado!")
+        logger.info("Chat Service inicializado!")
 
     def count_tokens(self, text: str) -> int:
         """Conta tokens em um texto"""
-        if not self.encoding:
-            self.encoding = tiktoken.encoding_for_model(settings.openai_model)
+        if not text:
+            return 0
 
-        return len(self.encoding.encode(text))
+        return len(self.encoding.encode_ordinary(text))
 
     def _map_category_to_doctype(self, category: DocumentCategory) -> DocType:
         """Mapeia categoria do documento para tipo de prompt"""
-        category_map = {
-            DocumentCategory.JURIDICO: DocType.JURIDICO,
-            DocumentCategory.FINANCEIRO: DocType.FINANCEIRO,
-            DocumentCategory.TECNICO: DocType.TECNICO
-        }
-        return category_map.get(category, DocType.GERAL)
+        return self._CATEGORY_MAP.get(category, DocType.GERAL)
 
     def build_context(self, query: str, chunks: List[Dict[str, Any]],
                      use_raptor: bool, raptor_tree: Optional[Dict[str, Any]] = None) -> str:
@@ -72,17 +105,21 @@ class ChatService:
         Returns:
             Contexto formatado para o LLM
         """
-        context_parts = []
+        raptor_summary = None
 
         # Se usar RAPTOR, adicionar resumo do nível mais alto
         if use_raptor and raptor_tree:
             raptor_summary = raptor_service.get_raptor_summary(raptor_tree, level=-1)
 
-            if raptor_summary:
-                context_parts.append(f"## RESUMO EXECUTIVO DO DOCUMENTO\n{raptor_summary}\n")
+        # Pré-alocar as partes: [resumo] + cabeçalho + um trecho por chunk
+        offset = 2 if raptor_summary else 1
+        context_parts = [None] * (offset + len(chunks))
+
+        if raptor_summary:
+            context_parts[0] = f"## RESUMO EXECUTIVO DO DOCUMENTO\n{raptor_summary}\n"
 
         # Adicionar chunks relevantes
-        context_parts.append("## TRECHOS RELEVANTES DO DOCUMENTO\n")
+        context_parts[offset - 1] = "## TRECHOS RELEVANTES DO DOCUMENTO\n"
 
         for i, chunk in enumerate(chunks):
             page = chunk["metadata"].get("page", "N/A")
@@ -92,26 +129,99 @@ class ChatService:
             if len(text) > 500:
                 text = text[:500] + "..."
 
-            context_parts.append(f"\n[Trecho {i+1} - Página {page}]")
-            context_parts.append(text)
+            context_parts[offset + i] = f"\n[Trecho {i+1} - Página {page}]\n{text}"
+
+        # Estimativa barata (~4 caracteres/token) antes de tokenizar de fato
+        approx_tokens = sum(len(part) for part in context_parts) >> 2
+
+        if approx_tokens > settings.max_context_tokens * 0.9:
+            # Tokenizar todas as partes em lote (uma única chamada ao tokenizer)
+            encoded_parts = self.encoding.encode_ordinary_batch(context_parts, num_threads=4)
 
-        # Controlar tamanho do contexto
-        full_context = "\n".join(context_parts)
+            # +1 por parte para o separador "\n" da junção
+            if sum(len(tokens) for tokens in encoded_parts) + len(context_parts) > settings.max_context_tokens:
+                available_tokens = settings.max_context_tokens - 500  # Reservar espaço para prompt
 
-        if self.count_tokens(full_context) > settings.max_context_tokens:
-            # Truncar se necessário
-            available_tokens = settings.max_context_tokens - 500  # Reservar espaço para prompt
+                # Manter as partes iniciais enquanto couberem no orçamento
+                used_tokens = 0
+                keep = 0
+                for tokens in encoded_parts:
+                    if used_tokens + len(tokens) + 1 > available_tokens:
+                        break
+                    used_tokens += len(tokens) + 1
+                    keep += 1
 
-            # Estimar caracteres por token (aproximadamente 4)
-            max_chars = available_tokens * 4
+                truncated_parts = context_parts[:keep]
 
-            full_context = full_context[:max_chars]
-            full_context += "\n\n[⚠️ Contexto truncado devido ao limite de tokens]"
+                # Cortar a parte que ultrapassa o limite no nível de tokens
+                remaining_tokens = available_tokens - used_tokens - 1
+                if remaining_tokens > 0:
+                    truncated_parts.append(self.encoding.decode(encoded_parts[keep][:remaining_tokens]))
 
-        return full_context
+                truncated_parts.append("\n[⚠️ Contexto truncado devido ao limite de tokens]")
+                context_parts = truncated_parts
+
+        return "\n".join(context_parts)
+
+    async def _complete(self, system_prompt: str, user_prompt: str, max_tokens: int,
+                        cache_key: Optional[str] = None) -> str:
+        """
+        Executa uma chamada ao LLM de forma assíncrona
 
-    def chat_with_cot(self, query: str, document_id: str, doc_metadata: Dict[str, Any],
-                     history: List[ChatMessage] = [], use_raptor: bool = True) -> ChatResponse:
+        Requisições idênticas em andamento são agrupadas: apenas uma chamada
+        é feita à API e todas as requisições concorrentes recebem o mesmo
+        resultado. cache_key (o ID do documento) agrupa no provedor as
+        requisições que compartilham o mesmo prefixo de prompt.
+        """
+        key = (system_prompt, user_prompt, max_tokens)
+
+        pending = self._inflight.get(key)
+        if pending is None:
+            pending = asyncio.ensure_future(
+                self._request_completion(system_prompt, user_prompt, max_tokens, cache_key)
+            )
+            self._inflight[key] = pending
+            pending.add_done_callback(lambda _: self._inflight.pop(key, None))
+
+        return await asyncio.shield(pending)
+
+    async def _request_completion(self, system_prompt: str, user_prompt: str, max_tokens: int,
+                                  cache_key: Optional[str] = None) -> str:
+        """Envia a requisição ao LLM respeitando o limite de concorrência"""
+        async with self._llm_semaphore:
+            response = await self.llm_client.chat.completions.create(
+                model=settings.openai_model,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_prompt}
+                ],
+                temperature=0.3,
+                max_tokens=max_tokens,
+                extra_body=_prompt_cache_body(cache_key)
+            )
+
+        return response.choices[0].message.content.strip()
+
+    async def _retrieve(self, query: str, document_id: str,
+                        use_raptor: bool) -> Tuple[List[Dict[str, Any]], Optional[Dict[str, Any]]]:
+        """Executa a busca RAG e o carregamento da árvore RAPTOR em paralelo"""
+        rag_task = asyncio.to_thread(
+            rag_service.hybrid_search,
+            query=query,
+            top_k=settings.top_k_results,
+            document_id=document_id
+        )
+
+        if not use_raptor:
+            return await rag_task, None
+
+        tree_task = asyncio.to_thread(raptor_service.load_raptor_tree, document_id)
+
+        rag_results, raptor_tree = await asyncio.gather(rag_task, tree_task)
+        return rag_results, raptor_tree
+
+    async def chat_with_cot(self, query: str, document_id: str, doc_metadata: Dict[str, Any],
+                     history: Optional[Sequence[ChatMessage]] = None, use_raptor: bool = True) -> ChatResponse:
         """
         Gera resposta usando Chain of Thought estruturado
 
@@ -125,15 +235,13 @@ class ChatService:
         Returns:
             Resposta do chat com fontes e raciocínio
         """
+        history = deque(history or (), maxlen=MAX_HISTORY_MESSAGES)
+
         if not self.initialized:
             self.initialize()
 
-        # 1. Recuperar chunks via RAG
-        rag_results = rag_service.hybrid_search(
-            query=query,
-            top_k=settings.top_k_results,
-            document_id=document_id
-        )
+        # 1. Recuperar chunks via RAG (e árvore RAPTOR, em paralelo)
+        rag_results, raptor_tree = await self._retrieve(query, document_id, use_raptor)
 
         if not rag_results:
             return ChatResponse(
@@ -142,15 +250,11 @@ class ChatService:
                 model=settings.openai_model
             )
 
-        # 2. Se usando RAPTOR, carregar árvore e recuperar resumo
+        # 2. Se usando RAPTOR, recuperar resumo
         raptor_summary = None
-        raptor_tree = None
-
-        if use_raptor:
-            raptor_tree = raptor_service.load_raptor_tree(document_id)
 
-            if raptor_tree:
-                raptor_summary = raptor_service.get_raptor_summary(raptor_tree)
+        if raptor_tree:
+            raptor_summary = raptor_service.get_raptor_summary(raptor_tree)
 
         # 3. Construir contexto
         context = self.build_context(
@@ -175,33 +279,22 @@ class ChatService:
 
         # 6. Gerar resposta
         try:
-            response = self.llm_client.chat.completions.create(
-                model=settings.openai_model,
-                messages=[
-                    {"role": "system", "content": prompts["system"]},
-                    {"role": "user", "content": prompts["user"]}
-                ],
-                temperature=0.3,
-                max_tokens=2500  # Mais tokens para CoT
+            answer = await self._complete(
+                system_prompt=prompts["system"],
+                user_prompt=prompts["user"],
+                max_tokens=2500,  # Mais tokens para CoT
+                cache_key=document_id
             )
 
-            answer = response.choices[0].message.content.strip()
-
         except Exception as e:
-            print(f"Erro ao gerar resposta: {e}")
+            logger.error("Erro ao gerar resposta: %s", e)
             answer = f"Erro ao processar sua pergunta: {str(e)}"
 
         # 7. Validar resposta
         validation = self.prompt_manager.validate_response(answer, query, rag_results)
 
         # 8. Preparar fontes
-        sources = []
-        for chunk in rag_results:
-            sources.append({
-                "page": chunk["metadata"].get("page", "N/A"),
-                "score": chunk["score"],
-                "snippet": chunk["text"][:200] + "..." if len(chunk["text"]) > 200 else chunk["text"]
-            })
+        sources = self._build_sources(rag_results)
 
         return ChatResponse(
             answer=answer,
@@ -210,7 +303,7 @@ class ChatService:
             model=settings.openai_model
         )
 
-    def chat(self, query: str, document_id: str, history: List[ChatMessage] = [],
+    async def chat(self, query: str, document_id: str, history: Optional[Sequence[ChatMessage]] = None,
               use_raptor: bool = True, use_cot: bool = False, doc_metadata: Optional[Dict[str, Any]] = None) -> ChatResponse:
         """
         Gera resposta para uma query usando RAG
@@ -226,6 +319,8 @@ class ChatService:
         Returns:
             Resposta do chat com fontes
         """
+        history = deque(history or (), maxlen=MAX_HISTORY_MESSAGES)
+
         if not self.initialized:
             self.initialize()
 
@@ -242,18 +337,14 @@ class ChatService:
 
         # Escolher método de geração (CoT vs. simples)
         if use_cot:
-            return self.chat_with_cot(query, document_id, doc_metadata, history, use_raptor)
+            return await self.chat_with_cot(query, document_id, doc_metadata, history, use_raptor)
 
         # ==========================================
         # MÉTODO SIMPLEM (sem CoT explícito)
         # ==========================================
 
-        # 1. Recuperar chunks via RAG
-        rag_results = rag_service.hybrid_search(
-            query=query,
-            top_k=settings.top_k_results,
-            document_id=document_id
-        )
+        # 1. Recuperar chunks via RAG (e árvore RAPTOR, em paralelo)
+        rag_results, raptor_tree = await self._retrieve(query, document_id, use_raptor)
 
         if not rag_results:
             return ChatResponse(
@@ -262,15 +353,11 @@ class ChatService:
                 model=settings.openai_model
             )
 
-        # 2. Se usando RAPTOR, carregar árvore e recuperar resumo
+        # 2. Se usando RAPTOR, recuperar resumo
         raptor_summary = None
-        raptor_tree = None
-
-        if use_raptor:
-            raptor_tree = raptor_service.load_raptor_tree(document_id)
 
-            if raptor_tree:
-                raptor_summary = raptor_service.get_raptor_summary(raptor_tree)
+        if raptor_tree:
+            raptor_summary = raptor_service.get_raptor_summary(raptor_tree)
 
         # 3. Construir contexto
         context = self.build_context(
@@ -282,6 +369,7 @@ class ChatService:
 
         # 4. Mapear categoria para tipo de prompt
         doc_type = self._map_category_to_doctype(doc_metadata.get("category", DocumentCategory.OUTROS))
+        system_prompt = self.prompt_manager.SYSTEM_PROMPTS[doc_type]
 
         # 5. Construir prompt simples
         prompt = self.prompt_manager.get_chat_prompt_simple(
@@ -294,30 +382,19 @@ class ChatService:
 
         # 6. Gerar resposta
         try:
-            response = self.llm_client.chat.completions.create(
-                model=settings.openai_model,
-                messages=[
-                    {"role": "system", "content": self.prompt_manager.SYSTEM_PROMPTS[doc_type]},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.3,
-                max_tokens=2000
+            answer = await self._complete(
+                system_prompt=system_prompt,
+                user_prompt=prompt,
+                max_tokens=2000,
+                cache_key=document_id
             )
 
-            answer = response.choices[0].message.content.strip()
-
         except Exception as e:
-            print(f"Erro ao gerar resposta: {e}")
+            logger.error("Erro ao gerar resposta: %s", e)
             answer = f"Erro ao processar sua pergunta: {str(e)}"
 
         # 7. Preparar fontes
-        sources = []
-        for chunk in rag_results:
-            sources.append({
-                "page": chunk["metadata"].get("page", "N/A"),
-                "score": chunk["score"],
-                "snippet": chunk["text"][:200] + "..." if len(chunk["text"]) > 200 else chunk["text"]
-            })
+        sources = self._build_sources(rag_results)
 
         return ChatResponse(
             answer=answer,
@@ -326,7 +403,35 @@ class ChatService:
             model=settings.openai_model
         )
 
-    def summarize_document(self, document_id: str, pages: Optional[List[int]] = None,
+    @staticmethod
+    def _build_sources(rag_results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Prepara a lista de fontes a partir dos chunks recuperados"""
+        sources = []
+        for chunk in rag_results:
+            text = chunk["text"]
+            sources.append({
+                "page": chunk["metadata"].get("page", "N/A"),
+                "score": chunk["score"],
+                "snippet": text if len(text) <= 200 else text[:200] + "..."
+            })
+
+        return sources
+
+    def _fit_chunks_to_budget(self, chunks: List[Dict[str, Any]], max_tokens: int,
+                              max_chars: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Mantém os chunks iniciais cujo total de tokens cabe no orçamento"""
+        texts = [chunk["text"][:max_chars] for chunk in chunks]
+        encoded = self.encoding.encode_ordinary_batch(texts, num_threads=os.cpu_count() or 1)
+
+        used_tokens = 0
+        for i, tokens in enumerate(encoded):
+            used_tokens += len(tokens)
+            if used_tokens > max_tokens:
+                return chunks[:max(i, 1)]
+
+        return chunks
+
+    async def summarize_document(self, document_id: str, pages: Optional[List[int]] = None,
                         detail_level: str = "medium") -> str:
         """
         Gera um resumo do documento usando prompts aprimorados
@@ -342,8 +447,8 @@ class ChatService:
         if not self.initialized:
             self.initialize()
 
-        # 1. Carregar árvore RAPTOR
-        raptor_tree = raptor_service.load_raptor_tree(document_id)
+        # 1. Carregar árvore RAPTOR (leitura de disco: fora do event loop)
+        raptor_tree = await asyncio.to_thread(raptor_service.load_raptor_tree, document_id)
 
         if raptor_tree:
             # 2. Usar resumo do RAPTOR
@@ -362,7 +467,7 @@ class ChatService:
                 return summary
 
         # 3. Se não tem RAPTOR, usar chunks
-        chunks = rag_service.get_document_chunks(document_id)
+        chunks = await asyncio.to_thread(rag_service.get_document_chunks, document_id)
 
         if not chunks:
             return "Não foi possível gerar um resumo. Documento não indexado."
@@ -376,9 +481,14 @@ class ChatService:
         if not filtered_chunks:
             filtered_chunks = chunks[:10]  # Usar primeiros 10 chunks
 
+        # Limitar ao orçamento de tokens (reservando espaço para o prompt)
+        filtered_chunks = await asyncio.to_thread(
+            self._fit_chunks_to_budget, filtered_chunks, settings.max_context_tokens - 1500, max_chars=500
+        )
+
         # 4. Obter metadados do documento
         from app.persistence import persistence
-        doc_metadata = persistence.get_document(document_id)
+        doc_metadata = await asyncio.to_thread(persistence.get_document, document_id)
         doc_title = doc_metadata.title if doc_metadata else "Documento"
         page_count = doc_metadata.page_count if doc_metadata else 0
 
@@ -400,20 +510,15 @@ class ChatService:
 
         # 8. Gerar resumo com LLM
         try:
-            response = self.llm_client.chat.completions.create(
-                model=settings.openai_model,
-                messages=[
-                    {"role": "system", "content": self.prompt_manager.SYSTEM_PROMPTS[doc_type]},
-                    {"role": "user", "content": summary_prompt}
-                ],
-                temperature=0.3,
-                max_tokens=1500
+            return await self._complete(
+                system_prompt=self.prompt_manager.SYSTEM_PROMPTS[doc_type],
+                user_prompt=summary_prompt,
+                max_tokens=1500,
+                cache_key=document_id
             )
 
-            return response.choices[0].message.content.strip()
-
         except Exception as e:
-            print(f"Erro ao gerar resumo: {e}")
+            logger.error("Erro ao gerar resumo: %s", e)
             return combined_text[:500] + "..."
 
 
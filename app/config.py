@@ -5,6 +5,7 @@
 from pydantic_settings import BaseSettings
 from pathlib import Path
 from typing import List
+from functools import cached_property, lru_cache
 import os
 
 
@@ -26,6 +27,8 @@ class Settings(BaseSettings):
     # --- Embeddings ---
     huggingface_model: str = "sentence-transformers/all-MiniLM-L6-v2"
     huggingface_device: str = "cpu"
+    huggingface_backend: str = "onnx"  # "onnx" (ONNX Runtime) ou "torch"
+    huggingface_quantization: str = "avx2"  # int8 dinâmico (ONNX): "arm64", "avx2", "avx512", "avx512_vnni" ou "" (sem)
 
     # --- RAG Configuration ---
     chunk_size: int = 512
@@ -42,12 +45,17 @@ class Settings(BaseSettings):
     rrf_k: int = 60
     hybrid_weight_vector: float = 0.7
     hybrid_weight_keyword: float = 0.3
+    vector_ann_threshold: int = 50000  # Acima disso, troca a busca exata (IndexFlatIP) por índice aproximado
+    vector_flat_index: str = "Flat"  # Busca exata: "Flat" (float32) ou "SQfp16" (float16, metade da memória)
+    vector_index_factory: str = "IVF1024,PQ64x8"  # Índice aproximado (faiss.index_factory), ex.: "HNSW32,Flat", "IVF1024,SQ8"
+    vector_nprobe: int = 16  # Listas IVF visitadas por busca
+    vector_rerank_k: int = 100  # Candidatos reordenados com os embeddings originais
 
     # --- Server Configuration ---
     host: str = "0.0.0.0"
     port: int = 8000
-    reload: bool = True
-    workers: int = 1
+    reload: bool = False  # Apenas em desenvolvimento
+    workers: int = 1  # Índices em memória: mais workers não compartilham o índice
 
     # --- Paths ---
     pdfs_dir: str = "trabalho"
@@ -55,6 +63,9 @@ class Settings(BaseSettings):
     notes_dir: str = "notes"
     upload_max_size_mb: int = 50
 
+    # --- PDF Processing ---
+    pdf_text_backend: str = "pdfium"  # "pdfium" (rápido) ou "pdfplumber" (layout)
+
     # --- Security ---
     secret_key: str = "change-this-secret-key"
     allowed_origins: str = "http://localhost:8000"
@@ -72,27 +83,27 @@ class Settings(BaseSettings):
         env_file_encoding = "utf-8"
         case_sensitive = False
 
-    @property
+    @cached_property
     def pdfs_path(self) -> Path:
         """Caminho absoluto para o diretório de PDFs"""
         return Path(self.pdfs_dir).absolute()
 
-    @property
+    @cached_property
     def indexes_path(self) -> Path:
         """Caminho absoluto para o diretório de índices"""
         return Path(self.indexes_dir).absolute()
 
-    @property
+    @cached_property
     def notes_path(self) -> Path:
         """Caminho absoluto para o diretório de notas"""
         return Path(self.notes_dir).absolute()
 
-    @property
+    @cached_property
     def log_path(self) -> Path:
         """Caminho absoluto para o arquivo de log"""
         return Path(self.log_file).absolute()
 
-    @property
+    @cached_property
     def allowed_origins_list(self) -> List[str]:
         """Lista de origens permitidas para CORS"""
         return [origin.strip() for origin in self.allowed_origins.split(",")]
@@ -103,6 +114,13 @@ class Settings(BaseSettings):
             path.mkdir(parents=True, exist_ok=True)
 
 
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """Carrega as configurações uma única vez por processo"""
+    loaded = Settings()
+    loaded.ensure_directories()
+    return loaded
+
+
 # Instância global de configurações
-settings = Settings()
-settings.ensure_directories()
+settings = get_settings()
@@ -2,36 +2,58 @@
 # PDF Consultor - FastAPI Application
 # ==========================================
 
-from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, BackgroundTasks
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, Request, Response
+from fastapi.responses import FileResponse, JSONResponse, ORJSONResponse, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.staticfiles import StaticFiles
+from pydantic import BaseModel
 from pathlib import Path
 from typing import List, Optional
 from datetime import datetime
+import asyncio
+import logging
+import orjson
+import re
 import shutil
 import uuid
 
 from app.config import settings
 from app.models import (
-    DocumentList, DocumentUpdate, DocumentCategory,
+    DocumentMetadata, DocumentList, DocumentUpdate, DocumentCategory,
     NoteList, NoteMetadata, NoteType,
+    IndexationStatus,
     ChatRequest, ChatResponse,
     SummaryRequest, SummaryResponse,
     APIResponse
 )
-from app.pdf_processor import pdf_processor
+from app.pdf_processor import pdf_processor, PAGE_RENDER_DPI
 from app.rag_service import rag_service
 from app.raptor_service import raptor_service
 from app.chat_service import chat_service
 from app.persistence import persistence
+from app.tasks import indexing_queue
+
+
+# Configurar logging (console + arquivo)
+settings.log_path.parent.mkdir(parents=True, exist_ok=True)
+logging.basicConfig(
+    level=settings.log_level.upper(),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    handlers=[
+        logging.StreamHandler(),
+        logging.FileHandler(settings.log_path, encoding="utf-8")
+    ]
+)
 
 
 # Criar aplicação FastAPI
 app = FastAPI(
     title="PDF Consultor",
     description="Sistema de consulta a PDFs com RAG, RAPTOR e busca híbrida",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
 # Configurar CORS
@@ -43,10 +65,79 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Rotas que não passam pelo GZip: PDFs e PNGs já são comprimidos e o SSE
+# precisa entregar cada evento sem buffer
+UNCOMPRESSED_PATHS = re.compile(r"^/api/(documents/[^/]+/(download|page/[^/]+)|chat/stream)$")
+
+
+class SelectiveGZipMiddleware(GZipMiddleware):
+    """GZipMiddleware que deixa passar sem compressão as rotas de UNCOMPRESSED_PATHS"""
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and UNCOMPRESSED_PATHS.match(scope["path"]):
+            await self.app(scope, receive, send)
+            return
+
+        await super().__call__(scope, receive, send)
+
+
+# Comprimir respostas grandes (listas de documentos/notas, respostas do chat)
+app.add_middleware(SelectiveGZipMiddleware, minimum_size=1024, compresslevel=5)
+
 # Montar arquivos estáticos
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 
+# Respostas condicionais: o cliente sempre revalida, recebendo 304 se nada mudou
+REVALIDATE_CACHE_CONTROL = "private, no-cache"
+
+
+def trusted_response(model: BaseModel, headers: Optional[dict] = None) -> ORJSONResponse:
+    """
+    Serializa um modelo montado a partir de dados já validados
+
+    Retornar a resposta pronta evita que o FastAPI valide o modelo de novo
+    contra o response_model e o percorra com jsonable_encoder.
+    """
+    return ORJSONResponse(model.model_dump(), headers=headers)
+
+
+def is_not_modified(request: Request, etag: str) -> bool:
+    """Verifica se o If-None-Match do cliente corresponde ao ETag (comparação fraca)"""
+    if_none_match = request.headers.get("if-none-match")
+
+    if not if_none_match:
+        return False
+
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return "*" in tags or etag.removeprefix("W/") in tags
+
+
+def not_modified_response(etag: str, cache_control: str = REVALIDATE_CACHE_CONTROL) -> Response:
+    """Resposta 304 sem corpo"""
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": cache_control})
+
+
+def document_etag(doc: DocumentMetadata) -> str:
+    """ETag fraco dos metadados: muda a cada atualização do documento"""
+    return f'W/"{doc.id}-{doc.updated_at.timestamp()}-{doc.file_size}"'
+
+
+def unique_upload_path(category: DocumentCategory, filename: str) -> Path:
+    """Caminho livre para o upload na pasta da categoria (sufixo _N se o nome já existir)"""
+    category_path = settings.pdfs_path / category.value
+    category_path.mkdir(parents=True, exist_ok=True)
+
+    file_path = category_path / filename
+    counter = 1
+    while file_path.exists():
+        name, ext = filename.rsplit('.', 1)
+        file_path = category_path / f"{name}_{counter}.{ext}"
+        counter += 1
+
+    return file_path
+
+
 # --- Inicialização ---
 
 @app.on_event("startup")
@@ -66,34 +157,45 @@ async def startup_event():
     print("="*60 + "\n")
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Encerrar a fila de indexação e gravar alterações pendentes"""
+    indexing_queue.shutdown()
+    persistence.flush()
+
+
 # --- Rotas de Documentos ---
 
 @app.get("/api/documents", response_model=DocumentList)
 async def list_documents(category: Optional[DocumentCategory] = None):
     """Lista todos os documentos (ou por categoria)"""
     if category:
-        docs = persistence.get_documents_by_category(category)
+        docs = await run_in_threadpool(persistence.get_documents_by_category, category)
     else:
-        docs = persistence.get_all_documents()
+        docs = await run_in_threadpool(persistence.get_all_documents)
 
-    return DocumentList(documents=docs, total=len(docs))
+    return trusted_response(DocumentList.model_construct(documents=docs, total=len(docs)))
 
 
 @app.get("/api/documents/{document_id}")
-async def get_document(document_id: str):
+async def get_document(document_id: str, request: Request):
     """Recupera metadados de um documento específico"""
-    doc = persistence.get_document(document_id)
+    doc = await run_in_threadpool(persistence.get_document, document_id)
 
     if not doc:
         raise HTTPException(status_code=404, detail="Documento não encontrado")
 
-    return doc
+    etag = document_etag(doc)
+    if is_not_modified(request, etag):
+        return not_modified_response(etag)
+
+    return trusted_response(doc, headers={"ETag": etag, "Cache-Control": REVALIDATE_CACHE_CONTROL})
 
 
 @app.put("/api/documents/{document_id}")
 async def update_document(document_id: str, update: DocumentUpdate):
     """Atualiza título e categoria de um documento"""
-    success = persistence.update_document(document_id, {
+    success = await run_in_threadpool(persistence.update_document, document_id, {
         "title": update.title,
         "category": update.category.value if update.category else None
     })
@@ -105,44 +207,45 @@ async def update_document(document_id: str, update: DocumentUpdate):
 
 
 @app.delete("/api/documents/{document_id}")
-async def delete_document(document_id: str, background_tasks: BackgroundTasks):
+async def delete_document(document_id: str):
     """Exclui um documento e todos os seus anexos/índices"""
-    doc = persistence.get_document(document_id)
+    # Documento principal e anexos (em qualquer nível), coletados de uma vez
+    docs = await run_in_threadpool(persistence.get_document_with_attachments, document_id)
 
-    if not doc:
+    if not docs:
         raise HTTPException(status_code=404, detail="Documento não encontrado")
 
-    # Deletar arquivo
-    pdf_path = settings.pdfs_path / doc.path
-    if pdf_path.exists():
-        pdf_path.unlink()
+    ids = [doc.id for doc in docs]
 
-    # Deletar do índice RAG
-    background_tasks.add_task(rag_service.delete_document, document_id)
+    # Deletar arquivos PDF, índices RAPTOR e páginas renderizadas em paralelo
+    paths = [settings.pdfs_path / doc.path for doc in docs]
+    paths.extend(raptor_service.get_tree_path(doc_id) for doc_id in ids)
+    paths.extend(raptor_service.get_embeddings_path(doc_id) for doc_id in ids)
+    await asyncio.gather(
+        *(run_in_threadpool(path.unlink, missing_ok=True) for path in paths),
+        *(run_in_threadpool(shutil.rmtree, pdf_processor.get_page_cache_dir(doc_id), ignore_errors=True)
+          for doc_id in ids)
+    )
+    pdf_processor.invalidate_pdf_listing()
+    for doc_id in ids:
+        raptor_service.invalidate_document(doc_id)
 
-    # Deletar índice RAPTOR
-    raptor_tree_path = settings.indexes_path / f"raptor_{document_id}.json"
-    if raptor_tree_path.exists():
-        raptor_tree_path.unlink()
+    # Deletar do índice RAG
+    indexing_queue.enqueue_delete(ids)
 
     # Deletar notas
-    persistence.delete_notes_by_document(document_id)
+    await run_in_threadpool(persistence.delete_notes_by_documents, ids)
 
     # Deletar metadados
-    persistence.delete_document(document_id)
-
-    # Deletar anexos
-    attachments = persistence.get_documents_by_parent(document_id)
-    for attachment in attachments:
-        await delete_document(attachment.id, background_tasks)
+    await run_in_threadpool(persistence.delete_documents, ids)
 
     return APIResponse(success=True, message="Documento excluído com sucesso")
 
 
 @app.get("/api/documents/{document_id}/download")
-async def download_document(document_id: str):
+async def download_document(document_id: str, request: Request):
     """Baixa um arquivo PDF"""
-    doc = persistence.get_document(document_id)
+    doc = await run_in_threadpool(persistence.get_document, document_id)
 
     if not doc:
         raise HTTPException(status_code=404, detail="Documento não encontrado")
@@ -152,57 +255,61 @@ async def download_document(document_id: str):
     if not pdf_path.exists():
         raise HTTPException(status_code=404, detail="Arquivo não encontrado")
 
+    # ETag forte a partir do hash do conteúdo (documentos antigos: metadados)
+    etag = f'"{doc.file_hash}"' if doc.file_hash else document_etag(doc)
+    if is_not_modified(request, etag):
+        return not_modified_response(etag)
+
     return FileResponse(
         path=pdf_path,
         media_type="application/pdf",
-        filename=doc.filename
+        filename=doc.filename,
+        headers={"ETag": etag, "Cache-Control": REVALIDATE_CACHE_CONTROL}
     )
 
 
 @app.get("/api/documents/{document_id}/attachments")
 async def get_attachments(document_id: str):
     """Lista anexos de um documento"""
-    attachments = persistence.get_documents_by_parent(document_id)
+    attachments = await run_in_threadpool(persistence.get_documents_by_parent, document_id)
 
-    return DocumentList(documents=attachments, total=len(attachments))
+    return trusted_response(DocumentList.model_construct(documents=attachments, total=len(attachments)))
 
 
 @app.post("/api/documents/upload")
 async def upload_document(
     file: UploadFile = File(...),
     category: DocumentCategory = DocumentCategory.OUTROS,
-    parent_id: Optional[str] = None,
-    background_tasks: BackgroundTasks = None
+    parent_id: Optional[str] = None
 ):
     """Faz upload de um novo documento PDF"""
     # Validar arquivo
     if not file.filename.endswith('.pdf'):
         raise HTTPException(status_code=400, detail="Apenas arquivos PDF são permitidos")
 
-    # Criar diretório da categoria se não existir
-    category_path = settings.pdfs_path / category.value
-    category_path.mkdir(parents=True, exist_ok=True)
-
-    # Salvar arquivo
-    filename = file.filename
-    file_path = category_path / filename
-
-    # Se arquivo já existe, adicionar sufixo
-    counter = 1
-    while file_path.exists():
-        name, ext = filename.rsplit('.', 1)
-        file_path = category_path / f"{name}_{counter}.{ext}"
-        counter += 1
-
-    with open(file_path, "wb") as f:
-        shutil.copyfileobj(file.file, f)
+    # Salvar arquivo (na pasta da categoria, sem sobrescrever outro)
+    file_path = await run_in_threadpool(unique_upload_path, category, file.filename)
 
-    # Gerar ID e metadados
+    # Gravar em blocos calculando o ID (BLAKE3) na mesma passada
     from app.pdf_processor import PDFProcessor
     processor = PDFProcessor()
 
-    document_id = processor.generate_document_id(file_path.name)
-    metadata = processor.extract_metadata(file_path)
+    document_id = await run_in_threadpool(processor.save_with_document_id, file.file, file_path)
+
+    # Conteúdo já enviado: não duplicar o documento (nem seus índices); a
+    # categoria e o documento pai pedidos não se aplicam ao registro existente
+    existing = await run_in_threadpool(persistence.get_document, document_id)
+    if existing:
+        await run_in_threadpool(file_path.unlink)
+        processor.invalidate_pdf_listing()
+        raise HTTPException(
+            status_code=409,
+            detail={"message": "Documento já enviado anteriormente", "document_id": existing.id}
+        )
+
+    processor.invalidate_pdf_listing()
+    metadata = await run_in_threadpool(processor.extract_metadata, file_path)
+    file_stat = await run_in_threadpool(file_path.stat)
 
     doc = DocumentMetadata(
         id=document_id,
@@ -210,61 +317,28 @@ async def upload_document(
         title=metadata["title"] or file_path.stem,
         category=category,
         path=str(file_path.relative_to(settings.pdfs_path)),
-        file_size=file_path.stat().st_size,
+        file_size=file_stat.st_size,
         page_count=metadata["page_count"],
         created_at=datetime.now(),
         updated_at=datetime.now(),
         is_indexed=False,
-        parent_id=parent_id
+        parent_id=parent_id,
+        file_hash=document_id
     )
 
     # Salvar metadados
-    persistence.save_document(doc)
+    await run_in_threadpool(persistence.save_document, doc)
 
     # Indexar em background
-    if background_tasks:
-        background_tasks.add_task(index_document, document_id, file_path)
+    indexing_queue.enqueue_index(document_id, file_path)
 
     return doc
 
 
-def index_document(document_id: str, pdf_path: Path):
-    """Indexa um documento em background"""
-    from app.pdf_processor import PDFProcessor
-
-    print(f"Indexando documento {document_id}...")
-
-    processor = PDFProcessor()
-
-    # Extrair texto
-    text_by_page = processor.extract_text_with_layout(pdf_path)
-
-    # Criar chunks
-    chunks = []
-    for page_num, text in text_by_page.items():
-        if text.strip():
-            chunks.append({
-                "text": text,
-                "page": page_num
-            })
-
-    # Adicionar ao RAG
-    rag_service.add_documents(chunks, document_id)
-
-    # Construir RAPTOR
-    chunk_texts = [chunk["text"] for chunk in chunks]
-    raptor_service.build_and_index_document(chunk_texts, document_id)
-
-    # Marcar como indexado
-    persistence.set_document_indexed(document_id, len(chunks))
-
-    print(f"Documento {document_id} indexado com {len(chunks)} chunks")
-
-
 @app.post("/api/documents/{document_id}/reindex")
-async def reindex_document(document_id: str, background_tasks: BackgroundTasks):
+async def reindex_document(document_id: str):
     """Reindexa um documento existente"""
-    doc = persistence.get_document(document_id)
+    doc = await run_in_threadpool(persistence.get_document, document_id)
 
     if not doc:
         raise HTTPException(status_code=404, detail="Documento não encontrado")
@@ -274,19 +348,41 @@ async def reindex_document(document_id: str, background_tasks: BackgroundTasks):
     if not pdf_path.exists():
         raise HTTPException(status_code=404, detail="Arquivo não encontrado")
 
-    # Deletar índices antigos
-    rag_service.delete_document(document_id)
+    # Deletar índices antigos (na fila, antes da nova indexação)
+    indexing_queue.enqueue_delete([document_id])
 
-    raptor_tree_path = settings.indexes_path / f"raptor_{document_id}.json"
-    if raptor_tree_path.exists():
-        raptor_tree_path.unlink()
+    raptor_tree_path = raptor_service.get_tree_path(document_id)
+    await run_in_threadpool(raptor_tree_path.unlink, missing_ok=True)
+    await run_in_threadpool(raptor_service.get_embeddings_path(document_id).unlink, missing_ok=True)
+    raptor_service.invalidate_document(document_id)
 
     # Reindexar
-    background_tasks.add_task(index_document, document_id, pdf_path)
+    indexing_queue.enqueue_index(document_id, pdf_path)
 
     return APIResponse(success=True, message="Documento está sendo reindexado")
 
 
+@app.get("/api/documents/{document_id}/status", response_model=IndexationStatus)
+async def get_indexation_status(document_id: str):
+    """Retorna o estado de indexação de um documento"""
+    doc = await run_in_threadpool(persistence.get_document, document_id)
+
+    if not doc:
+        raise HTTPException(status_code=404, detail="Documento não encontrado")
+
+    job = indexing_queue.get_status(document_id) or {}
+
+    return IndexationStatus(
+        document_id=document_id,
+        is_indexed=doc.is_indexed,
+        indexed_at=doc.indexed_at,
+        chunk_count=job.get("result") if job.get("task") == "index" else None,
+        task=job.get("task"),
+        task_status=job.get("status"),
+        error=job.get("error")
+    )
+
+
 # --- Rotas de Chat ---
 
 @app.post("/api/chat", response_model=ChatResponse)
@@ -295,7 +391,7 @@ async def chat(request: ChatRequest):
     if not chat_service.initialized:
         raise HTTPException(status_code=500, detail="Serviço de chat não inicializado")
 
-    response = chat_service.chat(
+    response = await chat_service.chat(
         query=request.query,
         document_id=request.document_id,
         history=request.history,
@@ -305,19 +401,37 @@ async def chat(request: ChatRequest):
     return response
 
 
+@app.post("/api/chat/stream")
+async def chat_stream(request: ChatRequest):
+    """Processa uma pergunta sobre um documento com resposta em streaming (SSE)"""
+    if not chat_service.initialized:
+        raise HTTPException(status_code=500, detail="Serviço de chat não inicializado")
+
+    async def event_stream():
+        async for event in chat_service.chat_stream(
+            query=request.query,
+            document_id=request.document_id,
+            history=request.history,
+            use_raptor=request.use_raptor
+        ):
+            yield b"data: " + orjson.dumps(event) + b"\n\n"
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+
 @app.post("/api/documents/{document_id}/summary", response_model=SummaryResponse)
 async def summarize_document(document_id: str, request: SummaryRequest):
     """Gera um resumo do documento"""
     if not chat_service.initialized:
         raise HTTPException(status_code=500, detail="Serviço de chat não inicializado")
 
-    summary = chat_service.summarize_document(
+    summary = await chat_service.summarize_document(
         document_id=document_id,
         pages=request.pages,
         detail_level=request.detail_level
     )
 
-    doc = persistence.get_document(document_id)
+    doc = await run_in_threadpool(persistence.get_document, document_id)
 
     return SummaryResponse(
         summary=summary,
@@ -329,11 +443,20 @@ async def summarize_document(document_id: str, request: SummaryRequest):
 # --- Rotas de Notas ---
 
 @app.get("/api/documents/{document_id}/notes", response_model=NoteList)
-async def get_notes(document_id: str):
+async def get_notes(document_id: str, request: Request):
     """Lista todas as anotações de um documento"""
-    notes = persistence.get_notes_by_document(document_id)
+    notes = await run_in_threadpool(persistence.get_notes_by_document, document_id)
+
+    # Notas novas ou editadas avançam o maior updated_at; exclusões mudam o total
+    last_update = max((note.updated_at.timestamp() for note in notes), default=0)
+    etag = f'W/"{document_id}-{len(notes)}-{last_update}"'
+    if is_not_modified(request, etag):
+        return not_modified_response(etag)
 
-    return NoteList(notes=notes, total=len(notes))
+    return trusted_response(
+        NoteList.model_construct(notes=notes, total=len(notes)),
+        headers={"ETag": etag, "Cache-Control": REVALIDATE_CACHE_CONTROL}
+    )
 
 
 @app.post("/api/documents/{document_id}/notes")
@@ -342,7 +465,7 @@ async def create_note(document_id: str, note: NoteMetadata):
     note.id = str(uuid.uuid4())
     note.document_id = document_id
 
-    persistence.save_note(note)
+    await run_in_threadpool(persistence.save_note, note)
 
     return note
 
@@ -350,9 +473,9 @@ async def create_note(document_id: str, note: NoteMetadata):
 @app.put("/api/notes/{note_id}")
 async def update_note(note_id: str, note: NoteMetadata):
     """Atualiza uma anotação"""
-    success = persistence.update_note(note_id, {
-        "content": note.content,
-        "updated_at": datetime.now().isoformat()
+    # updated_at é definido por persistence.update_note
+    success = await run_in_threadpool(persistence.update_note, note_id, {
+        "content": note.content
     })
 
     if not success:
@@ -364,7 +487,7 @@ async def update_note(note_id: str, note: NoteMetadata):
 @app.delete("/api/notes/{note_id}")
 async def delete_note(note_id: str):
     """Exclui uma anotação"""
-    success = persistence.delete_note(note_id)
+    success = await run_in_threadpool(persistence.delete_note, note_id)
 
     if not success:
         raise HTTPException(status_code=404, detail="Nota não encontrada")
@@ -375,9 +498,9 @@ async def delete_note(note_id: str):
 # --- Rotas de Visualização ---
 
 @app.get("/api/documents/{document_id}/page/{page_number}")
-async def get_page_image(document_id: str, page_number: int):
+async def get_page_image(document_id: str, page_number: int, request: Request):
     """Retorna uma página do PDF como imagem"""
-    doc = persistence.get_document(document_id)
+    doc = await run_in_threadpool(persistence.get_document, document_id)
 
     if not doc:
         raise HTTPException(status_code=404, detail="Documento não encontrado")
@@ -387,34 +510,28 @@ async def get_page_image(document_id: str, page_number: int):
     if not pdf_path.exists():
         raise HTTPException(status_code=404, detail="Arquivo não encontrado")
 
-    # Converter página para imagem
-    from pdf2image import convert_from_path
-    from PIL import Image
-    import io
-
-    try:
-        images = convert_from_path(
-            pdf_path,
-            first_page=page_number,
-            last_page=page_number,
-            dpi=150
-        )
+    # Renderizações ficam em cache em disco; o ID deriva do conteúdo do
+    # arquivo, então uma página renderizada nunca fica desatualizada
+    image_path = pdf_processor.get_page_cache_dir(document_id) / f"{page_number}_{PAGE_RENDER_DPI}.png"
 
-        if not images:
-            raise HTTPException(status_code=404, detail="Página não encontrada")
+    etag = f'"{document_id}-{page_number}-{PAGE_RENDER_DPI}"'
+    if is_not_modified(request, etag):
+        return not_modified_response(etag)
 
-        # Converter para bytes
-        img_byte_arr = io.BytesIO()
-        images[0].save(img_byte_arr, format='PNG')
-        img_byte_arr = img_byte_arr.getvalue()
+    if not image_path.exists():
+        try:
+            rendered = await run_in_threadpool(pdf_processor.render_page_png, pdf_path, page_number, image_path)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Erro ao processar página: {str(e)}")
 
-        return FileResponse(
-            path=pdf_path,  # Retornar o arquivo diretamente (navegador renderiza PDF)
-            media_type="application/pdf"
-        )
+        if not rendered:
+            raise HTTPException(status_code=404, detail="Página não encontrada")
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Erro ao processar página: {str(e)}")
+    return FileResponse(
+        path=image_path,
+        media_type="image/png",
+        headers={"ETag": etag, "Cache-Control": REVALIDATE_CACHE_CONTROL}
+    )
 
 
 # --- Rotas de Sistema ---
@@ -422,22 +539,15 @@ async def get_page_image(document_id: str, page_number: int):
 @app.get("/api/stats")
 async def get_stats():
     """Retorna estatísticas do sistema"""
-    docs = persistence.get_all_documents()
+    counts = await run_in_threadpool(persistence.get_document_counts)
 
-    indexed_count = sum(1 for doc in docs if doc.is_indexed)
-
-    index_stats = rag_service.get_index_stats()
+    index_stats = await run_in_threadpool(rag_service.get_index_stats)
 
     return {
-        "total_documents": len(docs),
-        "indexed_documents": indexed_count,
+        "total_documents": counts["total"],
+        "indexed_documents": counts["indexed"],
         "total_chunks": index_stats["total_chunks"],
-        "categories": {
-            "juridico": len([d for d in docs if d.category == DocumentCategory.JURIDICO]),
-            "financeiro": len([d for d in docs if d.category == DocumentCategory.FINANCEIRO]),
-            "tecnico": len([d for d in docs if d.category == DocumentCategory.TECNICO]),
-            "outros": len([d for d in docs if d.category == DocumentCategory.OUTROS])
-        }
+        "categories": counts["categories"]
     }
 
 
@@ -451,7 +561,9 @@ async def root():
     if not html_path.exists():
         return {"message": "Interface HTML não encontrada. Use a API REST."}
 
-    return HTMLResponse(content=html_path.read_text(encoding="utf-8"))
+    content = await run_in_threadpool(html_path.read_text, encoding="utf-8")
+
+    return HTMLResponse(content=content)
 
 
 # --- Execução Local ---
@@ -459,10 +571,14 @@ async def root():
 if __name__ == "__main__":
     import uvicorn
 
+    # O índice FAISS e a fila de indexação vivem em memória: manter um
+    # único worker (reload apenas em desenvolvimento)
     uvicorn.run(
-        "main:app",
+        "app.main:app",
         host=settings.host,
         port=settings.port,
         reload=settings.reload,
-        workers=settings.workers
+        workers=1 if settings.reload else settings.workers,
+        loop="uvloop",
+        http="httptools"
     )
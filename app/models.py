@@ -30,6 +30,7 @@ class DocumentMetadata(BaseModel):
     indexed_at: Optional[datetime] = Field(None, description="Data da última indexação")
     is_indexed: bool = Field(default=False, description="Se o documento está indexado")
     parent_id: Optional[str] = Field(None, description="ID do documento principal (se for anexo)")
+    file_hash: Optional[str] = Field(None, description="Impressão digital BLAKE3 do conteúdo do arquivo")
 
 
 class DocumentList(BaseModel):
@@ -130,6 +131,9 @@ class IndexationStatus(BaseModel):
     indexed_at: Optional[datetime] = Field(None, description="Data da última indexação")
     chunk_count: Optional[int] = Field(None, description="Número de chunks indexados")
     raptor_layers: Optional[int] = Field(None, description="Número de camadas RAPTOR")
+    task: Optional[str] = Field(None, description="Última tarefa na fila: 'index' ou 'delete'")
+    task_status: Optional[str] = Field(None, description="Estado da tarefa: 'pending', 'running', 'done', 'failed'")
+    error: Optional[str] = Field(None, description="Erro da tarefa (se falhou)")
 
 
 class APIResponse(BaseModel):
@@ -2,14 +2,20 @@
 # PDF Consultor - PDF Processing Service
 # ==========================================
 
-import hashlib
 import json
+import multiprocessing
+import os
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Iterator, Optional, BinaryIO, Tuple, Union
 from datetime import datetime
+from functools import lru_cache
 
+from blake3 import blake3
 from pypdf import PdfReader
 from pdfplumber import PDF
+import pypdfium2 as pdfium
 import pytesseract
 from PIL import Image
 
@@ -17,20 +23,188 @@ from app.config import settings
 from app.models import DocumentCategory
 
 
+# Tamanho dos blocos lidos ao calcular a impressão digital do arquivo
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Abaixo deste número de páginas a extração sequencial é mais rápida
+PARALLEL_MIN_PAGES = 8
+
+# Processos de extração não usam fork: o servidor já tem threads (uvicorn, ONNX
+# Runtime, fila de queries) e um fork pode herdar um lock travado por uma delas
+PROCESS_CONTEXT = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+
+# Estratégia de detecção de tabelas do pdfplumber (por linhas de grade)
+TABLE_SETTINGS = {
+    "vertical_strategy": "lines",
+    "horizontal_strategy": "lines",
+    "intersection_tolerance": 5,
+    "snap_tolerance": 3,
+}
+
+# Resolução das páginas renderizadas para visualização
+PAGE_RENDER_DPI = 150
+
+# Resolução e parâmetros do OCR (200 DPI em tons de cinza é o recomendado pelo Tesseract)
+OCR_DPI = 200
+OCR_LANG = "por"
+OCR_CONFIG = "--oem 1"
+
+
+def _extract_page_range(pdf_path: Path, start: int, end: Optional[int] = None,
+                        backend: str = "pdfium") -> Dict[int, str]:
+    """
+    Extrai texto das páginas [start, end) do PDF
+
+    Usado tanto na extração sequencial quanto em processos separados.
+    O backend "pdfium" (PDFium nativo) é muito mais rápido; "pdfplumber"
+    preserva melhor o layout em PDFs complexos.
+    """
+    text_by_page = {}
+
+    if backend == "pdfplumber":
+        with PDF.open(pdf_path) as pdf:
+            for i, page in enumerate(pdf.pages[start:end], start):
+                text = page.extract_text()
+                if text and text.strip():
+                    text_by_page[i + 1] = text
+
+        return text_by_page
+
+    pdf = pdfium.PdfDocument(str(pdf_path))
+    try:
+        for i in range(start, len(pdf) if end is None else end):
+            page = pdf[i]
+            textpage = page.get_textpage()
+            text = textpage.get_text_range().replace("\r\n", "\n")
+            textpage.close()
+            page.close()
+
+            if text.strip():
+                text_by_page[i + 1] = text
+    finally:
+        pdf.close()
+
+    return text_by_page
+
+
+def _extract_tables_range(pdf_path: Path, start: int, end: Optional[int] = None) -> List[List[List[str]]]:
+    """
+    Extrai tabelas das páginas [start, end) do PDF
+
+    Páginas sem linhas, retângulos ou curvas não têm as linhas de grade de
+    que a estratégia "lines" precisa e são puladas sem rodar a detecção.
+    """
+    tables = []
+
+    with PDF.open(pdf_path) as pdf:
+        for page in pdf.pages[start:end]:
+            if not (page.lines or page.rects or page.curves):
+                continue
+
+            page_tables = page.extract_tables(table_settings=TABLE_SETTINGS)
+            if page_tables:
+                tables.extend(page_tables)
+
+    return tables
+
+
+def _split_pages(page_count: int, workers: int) -> List[Tuple[int, int]]:
+    """Divide as páginas em faixas contíguas, uma por processo"""
+    step, extra = divmod(page_count, workers)
+    ranges = []
+    start = 0
+    for w in range(workers):
+        end = start + step + (1 if w < extra else 0)
+        ranges.append((start, end))
+        start = end
+
+    return ranges
+
+
+@lru_cache(maxsize=4)
+def _open_reader(path: str, mtime_ns: int) -> PdfReader:
+    """
+    Abre um PdfReader; o mtime na chave descarta versões antigas do arquivo
+
+    O PdfReader mantém o arquivo inteiro em memória, por isso o cache é pequeno:
+    serve para o mesmo PDF lido em sequência no upload e na indexação.
+    """
+    return PdfReader(path)
+
+
+def _get_reader(pdf_path: Path) -> PdfReader:
+    """Retorna o PdfReader do arquivo, reaproveitando o já processado se não mudou"""
+    return _open_reader(str(pdf_path), pdf_path.stat().st_mtime_ns)
+
+
+# Listagens de PDFs por diretório: caminho -> (mtime_ns do diretório, arquivos)
+_pdf_listing_cache: Dict[Path, Tuple[int, List[Path]]] = {}
+
+
+def _scan_pdfs(root: Path) -> List[Path]:
+    """Percorre o diretório recursivamente com os.scandir coletando arquivos .pdf"""
+    pdf_files = []
+    stack = [root]
+
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(".pdf") and entry.is_file():
+                    pdf_files.append(Path(entry.path))
+
+    pdf_files.sort()
+    return pdf_files
+
+
 class PDFProcessor:
     """Serviço para processamento de arquivos PDF"""
 
-    def __init__(self):
+    def __init__(self, text_backend: Optional[str] = None):
         self.pdfs_path = settings.pdfs_path
+        self.text_backend = text_backend or settings.pdf_text_backend
+
+    def generate_document_id(self, pdf_path: Path) -> str:
+        """
+        Gera ID do documento a partir do conteúdo do arquivo (BLAKE3)
 
-    def generate_document_id(self, filename: str) -> str:
-        """Gera ID único para documento baseado no nome e timestamp"""
-        content = f"{filename}_{datetime.now().timestamp()}"
-        return hashlib.md5(content.encode()).hexdigest()
+        Arquivos com o mesmo conteúdo recebem o mesmo ID, permitindo
+        reaproveitar metadados e índices em uploads repetidos.
+        """
+        hasher = blake3()
+
+        with open(pdf_path, "rb") as f:
+            for block in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                hasher.update(block)
+
+        return hasher.hexdigest()
+
+    def save_with_document_id(self, source: BinaryIO, pdf_path: Path) -> str:
+        """
+        Grava o conteúdo de source em pdf_path e retorna o ID do documento
+
+        O hash é calculado sobre os mesmos blocos gravados em disco, sem
+        reler o arquivo depois.
+        """
+        hasher = blake3()
+
+        with open(pdf_path, "wb") as f:
+            for block in iter(lambda: source.read(HASH_CHUNK_SIZE), b""):
+                hasher.update(block)
+                f.write(block)
+
+        return hasher.hexdigest()
 
     def extract_metadata(self, pdf_path: Path) -> Dict[str, Any]:
         """Extrai metadados básicos do PDF"""
-        reader = PdfReader(pdf_path)
+        reader = _get_reader(pdf_path)
 
         metadata = {
             "page_count": len(reader.pages),
@@ -47,7 +221,7 @@ class PDFProcessor:
 
     def extract_text(self, pdf_path: Path, pages: Optional[List[int]] = None) -> Dict[int, str]:
         """Extrai texto de um PDF, opcionalmente de páginas específicas"""
-        reader = PdfReader(pdf_path)
+        reader = _get_reader(pdf_path)
         text_by_page = {}
 
         for i, page in enumerate(reader.pages):
@@ -59,51 +233,150 @@ class PDFProcessor:
         return text_by_page
 
     def extract_text_with_layout(self, pdf_path: Path) -> Dict[int, str]:
-        """Extrai texto preservando layout usando pdfplumber"""
+        """Extrai texto de todas as páginas usando o backend configurado"""
+        return _extract_page_range(pdf_path, 0, backend=self.text_backend)
+
+    def extract_text_with_layout_parallel(self, pdf_path: Path,
+                                          workers: Optional[int] = None) -> Dict[int, str]:
+        """Extrai texto preservando layout, distribuindo as páginas entre processos"""
         text_by_page = {}
 
-        with PDF.open(pdf_path) as pdf:
-            for i, page in enumerate(pdf.pages):
-                text = page.extract_text()
-                if text and text.strip():
-                    text_by_page[i + 1] = text
+        for batch in self.iter_text_with_layout_parallel(pdf_path, workers):
+            text_by_page.update(batch)
 
         return text_by_page
 
-    def extract_tables(self, pdf_path: Path) -> List[List[List[str]]]:
-        """Extrai tabelas de um PDF"""
+    def iter_text_with_layout_parallel(self, pdf_path: Path,
+                                       workers: Optional[int] = None) -> Iterator[Dict[int, str]]:
+        """
+        Extrai texto em faixas de páginas processadas em paralelo
+
+        Entrega cada faixa, em ordem, assim que fica pronta, para que o
+        chamador processe as primeiras páginas enquanto as demais ainda
+        estão sendo extraídas.
+        """
+        pdf = pdfium.PdfDocument(str(pdf_path))
+        page_count = len(pdf)
+        pdf.close()
+
+        workers = min(workers or os.cpu_count() or 1, page_count)
+
+        if workers <= 1 or page_count < PARALLEL_MIN_PAGES:
+            yield self.extract_text_with_layout(pdf_path)
+            return
+
+        with ProcessPoolExecutor(max_workers=workers, mp_context=PROCESS_CONTEXT) as executor:
+            futures = [executor.submit(_extract_page_range, pdf_path, start, end, self.text_backend)
+                       for start, end in _split_pages(page_count, workers)]
+            for future in futures:
+                yield future.result()
+
+    def get_page_cache_dir(self, document_id: str) -> Path:
+        """Diretório com as páginas renderizadas de um documento"""
+        return settings.indexes_path / "pages" / document_id
+
+    def render_page_png(self, pdf_path: Path, page_number: int, dest: Path,
+                        dpi: int = PAGE_RENDER_DPI) -> bool:
+        """
+        Renderiza uma página como PNG em dest usando PDFium
+
+        Retorna False se a página não existir. O arquivo é gravado em um
+        temporário e renomeado, então leitores concorrentes nunca veem um
+        PNG incompleto.
+        """
+        pdf = pdfium.PdfDocument(str(pdf_path))
+        try:
+            if not 1 <= page_number <= len(pdf):
+                return False
+
+            page = pdf[page_number - 1]
+            image = page.render(scale=dpi / 72).to_pil()
+            page.close()
+        finally:
+            pdf.close()
+
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = dest.with_name(f"{dest.stem}.{uuid.uuid4().hex}.tmp")
+        image.save(tmp_path, format="PNG")
+        os.replace(tmp_path, dest)
+
+        return True
+
+    def extract_tables(self, pdf_path: Path, workers: Optional[int] = None) -> List[List[List[str]]]:
+        """Extrai tabelas de um PDF, distribuindo as páginas entre processos"""
+        pdf = pdfium.PdfDocument(str(pdf_path))
+        page_count = len(pdf)
+        pdf.close()
+
+        workers = min(workers or os.cpu_count() or 1, page_count)
+
+        if workers <= 1 or page_count < PARALLEL_MIN_PAGES:
+            return _extract_tables_range(pdf_path, 0)
+
         tables = []
 
-        with PDF.open(pdf_path) as pdf:
-            for page in pdf.pages:
-                page_tables = page.extract_tables()
-                if page_tables:
-                    tables.extend(page_tables)
+        with ProcessPoolExecutor(max_workers=workers, mp_context=PROCESS_CONTEXT) as executor:
+            futures = [executor.submit(_extract_tables_range, pdf_path, start, end)
+                       for start, end in _split_pages(page_count, workers)]
+            for future in futures:
+                tables.extend(future.result())
 
         return tables
 
     def ocr_page(self, pdf_path: Path, page_num: int) -> str:
         """Faz OCR de uma página específica usando Tesseract"""
+        return self.ocr_pages(pdf_path, [page_num]).get(page_num, "")
+
+    def ocr_pages(self, pdf_path: Path, pages: Optional[List[int]] = None,
+                  workers: Optional[int] = None) -> Dict[int, str]:
+        """
+        Faz OCR de várias páginas (ou do documento inteiro) usando Tesseract
+
+        As páginas são rasterizadas em uma única chamada ao Poppler e o
+        Tesseract roda em paralelo. Cada chamada do pytesseract é um processo
+        separado do Tesseract, então threads bastam para ocupar os núcleos.
+        """
         from pdf2image import convert_from_path
 
+        workers = workers or os.cpu_count() or 1
+
+        first_page = min(pages) if pages else None
+        last_page = max(pages) if pages else None
+
         images = convert_from_path(
             pdf_path,
-            first_page=page_num,
-            last_page=page_num,
-            dpi=300
+            first_page=first_page,
+            last_page=last_page,
+            dpi=OCR_DPI,
+            grayscale=True,
+            thread_count=workers
         )
 
-        if images:
-            text = pytesseract.image_to_string(images[0], lang='por')
-            return text
+        wanted = set(pages) if pages else None
+        page_images = {
+            page_num: image
+            for page_num, image in enumerate(images, first_page or 1)
+            if wanted is None or page_num in wanted
+        }
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            texts = executor.map(
+                lambda image: pytesseract.image_to_string(image, lang=OCR_LANG, config=OCR_CONFIG),
+                page_images.values()
+            )
+            return dict(zip(page_images.keys(), texts))
 
-        return ""
+    def is_scanned(self, pdf: Union[PdfReader, Path], sample_pages: int = 3) -> bool:
+        """
+        Verifica se o PDF parece ser digitalizado (texto não selecionável)
 
-    def is_scanned(self, pdf_path: Path, sample_pages: int = 3) -> bool:
-        """Verifica se o PDF parece ser digitalizado (texto não selecionável)"""
-        reader = PdfReader(pdf_path)
+        Aceita um PdfReader já aberto para evitar reprocessar o arquivo e
+        para de extrair texto assim que o resultado está decidido.
+        """
+        reader = pdf if isinstance(pdf, PdfReader) else _get_reader(pdf)
 
         pages_to_check = min(sample_pages, len(reader.pages))
+        threshold = 0.7 * pages_to_check
         scanned_count = 0
 
         for i in range(pages_to_check):
@@ -111,7 +384,12 @@ class PDFProcessor:
             if not text or len(text.strip()) < 50:
                 scanned_count += 1
 
-        return scanned_count / pages_to_check > 0.7
+            if scanned_count > threshold:
+                return True
+            if scanned_count + (pages_to_check - i - 1) <= threshold:
+                return False
+
+        return False
 
     def get_document_info(self, pdf_path: Path, document_id: str,
                          category: DocumentCategory = DocumentCategory.OUTROS,
@@ -120,6 +398,7 @@ class PDFProcessor:
         from app.models import DocumentMetadata
 
         metadata = self.extract_metadata(pdf_path)
+        stat = pdf_path.stat()
 
         doc_info = {
             "id": document_id,
@@ -127,10 +406,10 @@ class PDFProcessor:
             "title": metadata["title"] or pdf_path.stem,
             "category": category,
             "path": str(pdf_path.relative_to(self.pdfs_path)),
-            "file_size": pdf_path.stat().st_size,
+            "file_size": stat.st_size,
             "page_count": metadata["page_count"],
-            "created_at": datetime.fromtimestamp(pdf_path.stat().st_ctime),
-            "updated_at": datetime.fromtimestamp(pdf_path.stat().st_mtime),
+            "created_at": datetime.fromtimestamp(stat.st_ctime),
+            "updated_at": datetime.fromtimestamp(stat.st_mtime),
             "indexed_at": None,
             "is_indexed": False,
             "parent_id": parent_id,
@@ -153,22 +432,35 @@ class PDFProcessor:
 
     def get_all_pdfs(self) -> List[Path]:
         """Lista todos os arquivos PDF no diretório de trabalho"""
-        pdf_files = []
-
-        for pdf_file in self.pdfs_path.rglob("*.pdf"):
-            if pdf_file.is_file():
-                pdf_files.append(pdf_file)
-
-        return sorted(pdf_files)
+        return self._list_pdfs(self.pdfs_path)
 
     def get_pdfs_by_category(self, category: DocumentCategory) -> List[Path]:
         """Lista PDFs por categoria"""
-        category_path = self.pdfs_path / category.value
-
-        if not category_path.exists():
+        return self._list_pdfs(self.pdfs_path / category.value)
+
+    def invalidate_pdf_listing(self) -> None:
+        """Descarta as listagens em cache (chamar ao gravar ou excluir PDFs)"""
+        _pdf_listing_cache.clear()
+
+    def _list_pdfs(self, root: Path) -> List[Path]:
+        """
+        Lista os PDFs de um diretório, reaproveitando a última varredura
+
+        A listagem é refeita quando o mtime do diretório muda ou quando o
+        cache é invalidado; alterações apenas em subdiretórios exigem
+        invalidate_pdf_listing().
+        """
+        try:
+            mtime = root.stat().st_mtime_ns
+        except FileNotFoundError:
             return []
 
-        return sorted(category_path.rglob("*.pdf"))
+        cached = _pdf_listing_cache.get(root)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, _scan_pdfs(root))
+            _pdf_listing_cache[root] = cached
+
+        return list(cached[1])
 
     def get_pdf_by_id(self, document_id: str) -> Optional[Path]:
         """Encontra um PDF pelo ID (busca no índice de metadados)"""
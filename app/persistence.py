@@ -2,11 +2,17 @@
 # PDF Consultor - Persistence Service
 # ==========================================
 
-import json
+import fcntl
+import os
+import threading
+import time
+from contextlib import contextmanager
 from pathlib import Path
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Iterable, Set, Tuple
 from datetime import datetime
 
+import orjson
+
 from app.config import settings
 from app.models import (
     DocumentMetadata, DocumentCategory,
@@ -14,16 +20,123 @@ from app.models import (
 )
 
 
+# Segundos que uma alteração espera antes de ser gravada em disco;
+# alterações feitas nesse intervalo saem em uma única gravação
+FLUSH_DELAY = 1.0
+
+# Arquivo de trava (flock) de cada diretório de registros, compartilhado
+# entre processos que gravam no mesmo volume
+LOCK_FILE_NAME = ".lock"
+
+# Segundos durante os quais _now_iso() reaproveita o mesmo texto
+ISO_CACHE_SECONDS = 1.0
+
+_iso_cache = [float("-inf"), ""]
+
+
+def _now_iso() -> str:
+    """
+    Data/hora atual em ISO com resolução de até um segundo
+
+    Só para campos informativos como indexed_at: updated_at continua exato
+    porque compõe os ETags de documentos e notas.
+    """
+    now = time.monotonic()
+    if now - _iso_cache[0] >= ISO_CACHE_SECONDS:
+        _iso_cache[:] = [now, datetime.now().isoformat()]
+
+    return _iso_cache[1]
+
+# Índice secundário: chave -> IDs; dict sem valores como conjunto que
+# preserva a ordem de inserção do arquivo
+Index = Dict[str, Dict[str, None]]
+
+
+def _index_add(index: Index, key: Optional[str], item_id: str) -> None:
+    if key:
+        index.setdefault(key, {})[item_id] = None
+
+
+def _index_remove(index: Index, key: Optional[str], item_id: str) -> None:
+    bucket = index.get(key)
+    if bucket is not None:
+        bucket.pop(item_id, None)
+        if not bucket:
+            del index[key]
+
+
+# Campos gravados como texto ISO que os modelos expõem como datetime
+DOCUMENT_DATETIME_FIELDS = ("created_at", "updated_at", "indexed_at")
+NOTE_DATETIME_FIELDS = ("created_at", "updated_at")
+
+
+def _parse_datetimes(data: Dict[str, Any], fields: Tuple[str, ...]) -> None:
+    for field in fields:
+        value = data.get(field)
+        if isinstance(value, str):
+            data[field] = datetime.fromisoformat(value)
+
+
+def _document_from_dict(doc: Dict[str, Any]) -> DocumentMetadata:
+    """
+    Monta DocumentMetadata sem revalidar
+
+    Os registros foram gravados por este serviço a partir de modelos já
+    validados; basta converter de volta enum e datas.
+    """
+    data = dict(doc)
+    if data.get("category") is not None:
+        data["category"] = DocumentCategory(data["category"])
+    _parse_datetimes(data, DOCUMENT_DATETIME_FIELDS)
+
+    return DocumentMetadata.model_construct(**data)
+
+
+def _note_from_dict(note: Dict[str, Any]) -> NoteMetadata:
+    """Monta NoteMetadata sem revalidar (ver _document_from_dict)"""
+    data = dict(note)
+    if data.get("note_type") is not None:
+        data["note_type"] = NoteType(data["note_type"])
+    _parse_datetimes(data, NOTE_DATETIME_FIELDS)
+
+    return NoteMetadata.model_construct(**data)
+
+
 class PersistenceService:
     """Serviço de persistência de metadados e notas"""
 
     def __init__(self):
-        self.docs_file = settings.indexes_path / "documents.json"
-        self.notes_file = settings.notes_path / "notes.json"
-
-        # Garantir que arquivos existam
-        self.docs_file.parent.mkdir(parents=True, exist_ok=True)
-        self.notes_file.parent.mkdir(parents=True, exist_ok=True)
+        # Um arquivo JSON por registro: gravar um documento ou uma nota não
+        # reescreve os demais
+        self.docs_dir = settings.indexes_path / "docs"
+        self.notes_dir = settings.notes_path / "items"
+
+        # Arquivos únicos do formato anterior, migrados na primeira leitura
+        self.legacy_docs_file = settings.indexes_path / "documents.json"
+        self.legacy_notes_file = settings.notes_path / "notes.json"
+
+        # Registros em memória, relidos só quando o diretório muda por fora
+        # (mtime); as alterações deste serviço atualizam o cache
+        self._dirs = {"docs": self.docs_dir, "notes": self.notes_dir}
+        self._legacy_files = {"docs": self.legacy_docs_file, "notes": self.legacy_notes_file}
+        self._cache: Dict[str, Optional[Dict[str, Any]]] = {"docs": None, "notes": None}
+        self._mtime: Dict[str, Optional[int]] = {"docs": None, "notes": None}
+        self._lock = threading.RLock()
+
+        # Gravação adiada: IDs alterados aguardam o próximo flush
+        self._dirty: Dict[str, Set[str]] = {"docs": set(), "notes": set()}
+        self._flush_timer: Optional[threading.Timer] = None
+        self._batch_depth = 0
+
+        # Índices secundários, montados na primeira consulta e mantidos
+        # a cada alteração: documentos por categoria e por documento pai,
+        # notas por documento
+        self._docs_indexes: Optional[Tuple[Index, Index]] = None
+        self._notes_index: Optional[Index] = None
+
+        # Garantir que diretórios existam
+        self.docs_dir.mkdir(parents=True, exist_ok=True)
+        self.notes_dir.mkdir(parents=True, exist_ok=True)
 
     def _load_json(self, filepath: Path) -> Dict[str, Any]:
         """Carrega um arquivo JSON"""
@@ -31,162 +144,433 @@ class PersistenceService:
             return {}
 
         try:
-            with open(filepath, "r", encoding="utf-8") as f:
-                return json.load(f)
+            with open(filepath, "rb") as f:
+                # orjson decodifica direto dos bytes, sem passar por str
+                return orjson.loads(f.read())
         except Exception as e:
             print(f"Erro ao carregar {filepath}: {e}")
             return {}
 
     def _save_json(self, filepath: Path, data: Dict[str, Any]):
         """Salva dados em um arquivo JSON"""
-        with open(filepath, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        # Gravar em arquivo temporário e trocar de uma vez: uma falha no meio
+        # da escrita não deixa o arquivo original truncado
+        tmp_path = filepath.with_name(f"{filepath.name}.tmp")
+        tmp_path.write_bytes(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+        os.replace(tmp_path, filepath)
+
+    def _record_path(self, which: str, record_id: str) -> Path:
+        return self._dirs[which] / f"{record_id}.json"
+
+    def _dir_mtime(self, which: str) -> Optional[int]:
+        try:
+            return self._dirs[which].stat().st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    @contextmanager
+    def _file_lock(self, which: str):
+        """
+        Trava exclusiva entre processos sobre o diretório de "docs" ou "notes"
+
+        Dentro do processo as gravações já são serializadas por self._lock e
+        saem todas por flush(); a trava de arquivo impede que outro processo
+        grave os mesmos arquivos (e seus .tmp) ao mesmo tempo.
+        """
+        with open(self._dirs[which] / LOCK_FILE_NAME, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _migrate_legacy(self, which: str) -> None:
+        """Divide o arquivo único do formato anterior em um arquivo por registro"""
+        legacy_file = self._legacy_files[which]
+
+        for record_id, record in self._load_json(legacy_file).items():
+            self._save_json(self._record_path(which, record_id), record)
+
+        os.replace(legacy_file, legacy_file.with_name(f"{legacy_file.name}.migrated"))
+
+    def _load_records(self, which: str) -> Dict[str, Any]:
+        """Lê todos os registros de "docs" ou "notes" do disco"""
+        if self._legacy_files[which].exists():
+            with self._file_lock(which):
+                # Outro processo pode ter migrado enquanto esperávamos a trava
+                if self._legacy_files[which].exists():
+                    self._migrate_legacy(which)
+
+        records = {}
+        with os.scandir(self._dirs[which]) as entries:
+            for entry in entries:
+                if entry.name.endswith(".json"):
+                    record = self._load_json(Path(entry.path))
+                    if record:
+                        records[entry.name[:-len(".json")]] = record
+
+        # A ordem do diretório é arbitrária: listar por data de criação
+        return dict(sorted(records.items(), key=lambda item: item[1].get("created_at") or ""))
+
+    def _load_cached(self, which: str) -> Dict[str, Any]:
+        """
+        Retorna os registros em cache de "docs" ou "notes"
+
+        O diretório só é lido de novo se o mtime mudou desde a última leitura
+        ou gravação e não há alterações pendentes. Chamar com self._lock
+        adquirido quando for iterar ou alterar o dict retornado.
+        """
+        with self._lock:
+            data = self._cache[which]
+            if self._dirty[which]:
+                return data
+
+            if data is None or self._dir_mtime(which) != self._mtime[which]:
+                data = self._load_records(which)
+                self._cache[which] = data
+                self._mtime[which] = self._dir_mtime(which)
+                if which == "docs":
+                    self._docs_indexes = None
+                else:
+                    self._notes_index = None
+
+            return data
+
+    def _mark_dirty(self, which: str, record_ids: Iterable[str]) -> None:
+        """Registra alterações em registros de "docs" ou "notes" e agenda a gravação"""
+        with self._lock:
+            self._dirty[which].update(record_ids)
+
+            if self._dirty[which] and self._batch_depth == 0 and self._flush_timer is None:
+                self._flush_timer = threading.Timer(FLUSH_DELAY, self._timed_flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    def _timed_flush(self) -> None:
+        with self._lock:
+            # Um batch() aberto grava tudo ao terminar
+            if self._batch_depth == 0:
+                self.flush()
+
+    def flush(self) -> None:
+        """Grava em disco os registros com alterações pendentes"""
+        with self._lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+
+            for which, dirty in self._dirty.items():
+                if not dirty:
+                    continue
+
+                records = self._cache[which]
+                with self._file_lock(which):
+                    for record_id in dirty:
+                        record = records.get(record_id)
+                        if record is None:
+                            self._record_path(which, record_id).unlink(missing_ok=True)
+                        else:
+                            self._save_json(self._record_path(which, record_id), record)
+
+                dirty.clear()
+                self._mtime[which] = self._dir_mtime(which)
+
+    @contextmanager
+    def batch(self):
+        """Agrupa alterações: nada é gravado até o fim do bloco, e então tudo de uma vez"""
+        with self._lock:
+            self._batch_depth += 1
+
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._batch_depth -= 1
+                if self._batch_depth == 0:
+                    self.flush()
+
+    def _documents_indexes(self) -> Tuple[Index, Index]:
+        """IDs de documentos por categoria e por documento pai (chamar com self._lock)"""
+        docs = self._load_cached("docs")
+
+        if self._docs_indexes is None:
+            by_category: Index = {}
+            by_parent: Index = {}
+
+            for doc_id, doc in docs.items():
+                _index_add(by_category, doc.get("category"), doc_id)
+                _index_add(by_parent, doc.get("parent_id"), doc_id)
+
+            self._docs_indexes = (by_category, by_parent)
+
+        return self._docs_indexes
+
+    def _notes_by_document(self) -> Index:
+        """IDs de notas por documento (chamar com self._lock)"""
+        notes = self._load_cached("notes")
+
+        if self._notes_index is None:
+            notes_index: Index = {}
+
+            for note_id, note in notes.items():
+                _index_add(notes_index, note.get("document_id"), note_id)
+
+            self._notes_index = notes_index
+
+        return self._notes_index
+
+    def _reindex_document(self, doc_id: str, old: Optional[Dict[str, Any]],
+                          new: Optional[Dict[str, Any]]) -> None:
+        """Atualiza os índices de documentos após uma alteração (chamar com self._lock)"""
+        if self._docs_indexes is None:
+            return
+
+        by_category, by_parent = self._docs_indexes
+        if old is not None:
+            _index_remove(by_category, old.get("category"), doc_id)
+            _index_remove(by_parent, old.get("parent_id"), doc_id)
+        if new is not None:
+            _index_add(by_category, new.get("category"), doc_id)
+            _index_add(by_parent, new.get("parent_id"), doc_id)
+
+    def _reindex_note(self, note_id: str, old: Optional[Dict[str, Any]],
+                      new: Optional[Dict[str, Any]]) -> None:
+        """Atualiza o índice de notas após uma alteração (chamar com self._lock)"""
+        if self._notes_index is None:
+            return
+
+        if old is not None:
+            _index_remove(self._notes_index, old.get("document_id"), note_id)
+        if new is not None:
+            _index_add(self._notes_index, new.get("document_id"), note_id)
 
     # --- Documentos ---
 
     def save_document(self, doc: DocumentMetadata) -> None:
         """Salva metadados de um documento"""
-        docs = self._load_json(self.docs_file)
-        docs[doc.id] = doc.model_dump()
+        with self._lock:
+            docs = self._load_cached("docs")
+            data = doc.model_dump(mode="json")
+
+            self._reindex_document(doc.id, docs.get(doc.id), data)
+            docs[doc.id] = data
 
-        self._save_json(self.docs_file, docs)
+            self._mark_dirty("docs", [doc.id])
 
     def get_document(self, document_id: str) -> Optional[DocumentMetadata]:
         """Recupera metadados de um documento"""
-        docs = self._load_json(self.docs_file)
+        with self._lock:
+            doc = self._load_cached("docs").get(document_id)
 
-        if document_id not in docs:
-            return None
+            if doc is None:
+                return None
 
-        return DocumentMetadata(**docs[document_id])
+            return _document_from_dict(doc)
 
     def get_all_documents(self) -> List[DocumentMetadata]:
         """Recupera todos os documentos"""
-        docs = self._load_json(self.docs_file)
+        with self._lock:
+            docs = self._load_cached("docs")
 
-        return [DocumentMetadata(**doc) for doc in docs.values()]
+            return [_document_from_dict(doc) for doc in docs.values()]
 
     def get_documents_by_category(self, category: DocumentCategory) -> List[DocumentMetadata]:
         """Recupera documentos por categoria"""
-        docs = self._load_json(self.docs_file)
+        with self._lock:
+            docs = self._load_cached("docs")
+            by_category, _ = self._documents_indexes()
 
-        return [
-            DocumentMetadata(**doc)
-            for doc in docs.values()
-            if doc.get("category") == category.value
-        ]
+            return [_document_from_dict(docs[doc_id]) for doc_id in by_category.get(category.value, ())]
 
     def get_documents_by_parent(self, parent_id: str) -> List[DocumentMetadata]:
         """Recupera anexos de um documento principal"""
-        docs = self._load_json(self.docs_file)
+        with self._lock:
+            docs = self._load_cached("docs")
+            _, by_parent = self._documents_indexes()
+
+            return [_document_from_dict(docs[doc_id]) for doc_id in by_parent.get(parent_id, ())]
 
-        return [
-            DocumentMetadata(**doc)
-            for doc in docs.values()
-            if doc.get("parent_id") == parent_id
-        ]
+    def get_document_with_attachments(self, document_id: str) -> List[DocumentMetadata]:
+        """Recupera um documento e todos os seus anexos, em qualquer nível"""
+        with self._lock:
+            docs = self._load_cached("docs")
+
+            if document_id not in docs:
+                return []
+
+            _, by_parent = self._documents_indexes()
+
+            # Busca em largura a partir do documento principal
+            ids = [document_id]
+            seen = {document_id}
+            for current in ids:
+                for child_id in by_parent.get(current, ()):
+                    if child_id not in seen:
+                        seen.add(child_id)
+                        ids.append(child_id)
+
+            return [_document_from_dict(docs[doc_id]) for doc_id in ids]
 
     def update_document(self, document_id: str, updates: Dict[str, Any]) -> bool:
         """Atualiza metadados de um documento"""
-        docs = self._load_json(self.docs_file)
+        with self._lock:
+            docs = self._load_cached("docs")
 
-        if document_id not in docs:
-            return False
+            doc = docs.get(document_id)
+            if doc is None:
+                return False
 
-        docs[document_id].update(updates)
-        docs[document_id]["updated_at"] = datetime.now().isoformat()
+            # Só os campos indexados, não uma cópia do registro inteiro
+            old = {"category": doc.get("category"), "parent_id": doc.get("parent_id")}
+            doc.update(updates)
+            doc["updated_at"] = datetime.now().isoformat()
+            self._reindex_document(document_id, old, doc)
 
-        self._save_json(self.docs_file, docs)
-        return True
+            self._mark_dirty("docs", [document_id])
+            return True
 
     def delete_document(self, document_id: str) -> bool:
         """Remove metadados de um documento"""
-        docs = self._load_json(self.docs_file)
+        return self.delete_documents([document_id]) > 0
 
-        if document_id not in docs:
-            return False
+    def delete_documents(self, document_ids: List[str]) -> int:
+        """Remove metadados de vários documentos de uma vez"""
+        with self._lock:
+            docs = self._load_cached("docs")
 
-        del docs[document_id]
-        self._save_json(self.docs_file, docs)
-        return True
+            removed = []
+            for document_id in document_ids:
+                doc = docs.pop(document_id, None)
+                if doc is not None:
+                    self._reindex_document(document_id, doc, None)
+                    removed.append(document_id)
+
+            self._mark_dirty("docs", removed)
+
+            return len(removed)
 
     def set_document_indexed(self, document_id: str, chunk_count: int,
                             raptor_layers: Optional[int] = None) -> None:
         """Marca documento como indexado"""
         self.update_document(document_id, {
             "is_indexed": True,
-            "indexed_at": datetime.now().isoformat(),
+            "indexed_at": _now_iso(),
             "chunk_count": chunk_count,
             "raptor_layers": raptor_layers
         })
 
+    def get_document_counts(self) -> Dict[str, Any]:
+        """Conta documentos (total, indexados e por categoria)"""
+        with self._lock:
+            docs = self._load_cached("docs")
+            by_category, _ = self._documents_indexes()
+
+            categories = dict.fromkeys((category.value for category in DocumentCategory), 0)
+            for category, doc_ids in by_category.items():
+                categories[category] = len(doc_ids)
+
+            indexed = sum(1 for doc in docs.values() if doc.get("is_indexed"))
+
+            return {
+                "total": len(docs),
+                "indexed": indexed,
+                "categories": categories
+            }
+
     # --- Notas ---
 
     def save_note(self, note: NoteMetadata) -> None:
         """Salva uma anotação"""
-        notes = self._load_json(self.notes_file)
-        notes[note.id] = note.model_dump()
+        with self._lock:
+            notes = self._load_cached("notes")
+            data = note.model_dump(mode="json")
 
-        self._save_json(self.notes_file, notes)
+            self._reindex_note(note.id, notes.get(note.id), data)
+            notes[note.id] = data
+
+            self._mark_dirty("notes", [note.id])
 
     def get_note(self, note_id: str) -> Optional[NoteMetadata]:
         """Recupera uma anotação"""
-        notes = self._load_json(self.notes_file)
+        with self._lock:
+            note = self._load_cached("notes").get(note_id)
 
-        if note_id not in notes:
-            return None
+            if note is None:
+                return None
 
-        return NoteMetadata(**notes[note_id])
+            return _note_from_dict(note)
 
     def get_notes_by_document(self, document_id: str) -> List[NoteMetadata]:
         """Recupera todas as anotações de um documento"""
-        notes = self._load_json(self.notes_file)
+        with self._lock:
+            notes = self._load_cached("notes")
+            notes_by_doc = self._notes_by_document()
 
-        return [
-            NoteMetadata(**note)
-            for note in notes.values()
-            if note.get("document_id") == document_id
-        ]
+            return [_note_from_dict(notes[note_id]) for note_id in notes_by_doc.get(document_id, ())]
 
     def update_note(self, note_id: str, updates: Dict[str, Any]) -> bool:
         """Atualiza uma anotação"""
-        notes = self._load_json(self.notes_file)
+        with self._lock:
+            notes = self._load_cached("notes")
 
-        if note_id not in notes:
-            return False
+            note = notes.get(note_id)
+            if note is None:
+                return False
 
-        notes[note_id].update(updates)
-        notes[note_id]["updated_at"] = datetime.now().isoformat()
+            old = {"document_id": note.get("document_id")}
+            note.update(updates)
+            note["updated_at"] = datetime.now().isoformat()
+            self._reindex_note(note_id, old, note)
 
-        self._save_json(self.notes_file, notes)
-        return True
+            self._mark_dirty("notes", [note_id])
+            return True
 
     def delete_note(self, note_id: str) -> bool:
         """Remove uma anotação"""
-        notes = self._load_json(self.notes_file)
+        with self._lock:
+            notes = self._load_cached("notes")
 
-        if note_id not in notes:
-            return False
+            note = notes.pop(note_id, None)
+            if note is None:
+                return False
 
-        del notes[note_id]
-        self._save_json(self.notes_file, notes)
-        return True
+            self._reindex_note(note_id, note, None)
+            self._mark_dirty("notes", [note_id])
+            return True
 
     def delete_notes_by_document(self, document_id: str) -> int:
         """Remove todas as anotações de um documento"""
-        notes = self._load_json(self.notes_file)
-
-        to_delete = [
-            note_id for note_id, note in notes.items()
-            if note.get("document_id") == document_id
-        ]
-
-        for note_id in to_delete:
-            del notes[note_id]
-
-        self._save_json(self.notes_file, notes)
-
-        return len(to_delete)
+        return self.delete_notes_by_documents([document_id])
+
+    def delete_notes_by_documents(self, document_ids: List[str]) -> int:
+        """Remove todas as anotações de vários documentos de uma vez"""
+        with self._lock:
+            notes = self._load_cached("notes")
+
+            removed = []
+            if self._notes_index is not None:
+                # Com o índice pronto: O(k) nas notas removidas
+                for document_id in document_ids:
+                    for note_id in self._notes_index.pop(document_id, ()):
+                        del notes[note_id]
+                        removed.append(note_id)
+            else:
+                # Sem índice: uma única passada reconstruindo o dict, em vez de
+                # montar o índice inteiro só para esta remoção
+                ids = set(document_ids)
+                kept = {}
+                for note_id, note in notes.items():
+                    if note.get("document_id") in ids:
+                        removed.append(note_id)
+                    else:
+                        kept[note_id] = note
+
+                if removed:
+                    self._cache["notes"] = kept
+
+            self._mark_dirty("notes", removed)
+
+            return len(removed)
 
 
 # Instância global do serviço de persistência
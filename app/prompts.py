@@ -4,9 +4,29 @@
 # Gerenciador centralizado de prompts com CoT e Few-Shot
 # ==========================================
 
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Final, Sequence, Tuple
+from functools import lru_cache
+from itertools import islice
 from enum import Enum
 
+import tiktoken
+
+
+# Tokenizer usado para contar tokens dos trechos e prompts
+TOKEN_ENCODING = "cl100k_base"
+
+
+@lru_cache(maxsize=1)
+def _get_encoding() -> tiktoken.Encoding:
+    """Retorna o tokenizer (carregado na primeira contagem, uma vez por processo)"""
+    return tiktoken.get_encoding(TOKEN_ENCODING)
+
+
+@lru_cache(maxsize=4096)
+def _count_tokens(text: str) -> int:
+    """Conta tokens de um texto (memoizado: o mesmo trecho volta em várias consultas)"""
+    return len(_get_encoding().encode_ordinary(text))
+
 
 class DocType(str, Enum):
     """Tipos de documentos para prompts personalizados"""
@@ -23,6 +43,133 @@ class DetailLevel(str, Enum):
     DETAILED = "detalhado"
 
 
+# Partes constantes do prompt de chat simples (ver get_chat_prompt_simple)
+SIMPLE_CHAT_MIDDLE = """
+
+---
+
+## PERGUNTA DO USUÁRIO
+
+"""
+
+SIMPLE_CHAT_SUFFIX = """
+
+---
+
+## INSTRUÇÕES
+
+Com base nos trechos acima, responda à pergunta do usuário:
+
+1. **Resposta:** Forneça uma resposta clara e precisa
+2. **Citação:** Sempre cite a página no formato [Página X]
+3. **Clareza:** Seja conciso mas completo
+4. **Honestidade:** Se a informação não estiver no documento, diga "Não encontrei esta informação no documento"
+
+---
+
+RESPOSTA:"""
+
+# Partes constantes dos prompts de chat com CoT e few-shot: o esqueleto é
+# montado uma vez e só as partes variáveis são unidas a cada chamada
+CHAT_CONTEXT_END = "\n\n---\n\n"
+
+CHAT_QUERY_HEADER = "\n\n## PERGUNTA DO USUÁRIO\n\n"
+
+# Histórico incluído nos prompts de chat: últimas trocas, cada uma truncada
+HISTORY_HEADER = "\n\nHistórico de conversa (últimas 10 trocas):\n"
+HISTORY_WINDOW = 10
+HISTORY_MESSAGE_CHARS = 500
+
+COT_CHAT_SUFFIX = """
+
+---
+
+## INSTRUÇÕES
+
+### Etapa 1: Raciocínio (Chain of Thought)
+Analise a pergunta e os trechos fornecidos seguindo estas etapas:
+
+1. **Identificação de Trechos Relevantes:**
+   - Liste os trechos que diretamente respondem à pergunta
+   - Note a página de cada trecho
+
+2. **Análise da Relação:**
+   - Explique como cada trecho se relaciona com a pergunta
+   - Identifique informações complementares ou contraditórias
+
+3. **Síntese do Raciocínio:**
+   - Combine as informações dos trechos relevantes
+   - Formule uma resposta preliminar baseada nos trechos
+
+### Etapa 2: Resposta Direta
+Com base no seu raciocínio, forneça uma resposta clara e direta ao usuário:
+
+1. **Resposta:**
+   - Responda à pergunta de forma clara e concisa
+   - Sempre cite a página no formato [Página X]
+   - Seja objetivo e direto
+
+2. **Fontes:**
+   - Liste as páginas utilizadas: [Página X], [Página Y], ...
+   - Se aplicável, identifique trechos específicos
+
+3. **Avisos:**
+   - Se houver conflitos ou informações ambíguas, mencione
+   - Se a informação não estiver completa, note o que falta
+
+---
+
+**Formato da Resposta:**
+
+[RACIOCÍNIO]
+[Trechos Identificados]
+- Trecho 1 (Página X): [resumo ou citação]
+- Trecho 2 (Página Y): [resumo ou citação]
+
+[Análise da Relação]
+[Explique a conexão entre os trechos e a pergunta]
+
+[Conclusão Preliminar]
+[Resposta inicial baseada nos trechos]
+
+[RESPOSTA DIRETA]
+[Resposta clara e concisa]
+
+[Fontes]
+- [Página X]: [breve descrição do conteúdo]
+- [Página Y]: [breve descrição do conteúdo]
+
+[Avisos]
+[Quaisquer conflitos ou ambiguidades]
+
+---
+
+**Responda no formato acima.**"""
+
+FEWSHOT_CHAT_SUFFIX = """
+
+---
+
+## INSTRUÇÕES
+
+Com base nos trechos acima e seguindo o exemplo fornecido, responda à pergunta do usuário:
+
+1. **Raciocínio:** Analise os trechos relevantes e explique seu raciocínio
+2. **Resposta:** Forneça uma resposta clara e precisa
+3. **Citação:** Sempre cite a página no formato [Página X]
+4. **Formato:** Siga o formato do exemplo acima ([RACIOCÍNIO] e [RESPOSTA DIRETA])
+
+---
+
+RESPOSTA:"""
+
+# Partes constantes do prompt de síntese RAPTOR (ver get_raptor_prompt)
+RAPTOR_PROMPT_HEAD = """Você é um assistente especializado em criar sínteses hierárquicas de documentos.
+
+### Contexto
+"""
+
+
 class PromptManager:
     """
     Gerenciador centralizado de prompts para o PDF Consultor
@@ -38,7 +185,7 @@ class PromptManager:
     # Prompts de System
     # ==========================================
 
-    SYSTEM_PROMPTS = {
+    SYSTEM_PROMPTS: Final[Dict[DocType, str]] = {
         DocType.JURIDICO: """Você é um assistente especializado em análise jurídica de documentos.
 
 Sua abordagem:
@@ -111,6 +258,9 @@ Restrições:
 - Seja conciso mas completo"""
     }
 
+    # Prompt de system para categorias sem prompt próprio
+    DEFAULT_SYSTEM_PROMPT: Final[str] = SYSTEM_PROMPTS[DocType.GERAL]
+
     # ==========================================
     # Prompts de Chat com CoT
     # ==========================================
@@ -139,101 +289,16 @@ Restrições:
             Dict com prompts separados para CoT e resposta final
         """
         # Prompt de system
-        system_prompt = self.SYSTEM_PROMPTS.get(category, self.SYSTEM_PROMPTS[DocType.GERAL])
+        system_prompt = self.SYSTEM_PROMPTS.get(category, self.DEFAULT_SYSTEM_PROMPT)
 
         # Histórico formatado
-        history_text = ""
-        if history:
-            history_text = "\n\nHistórico de conversa (últimas 10 trocas):\n"
-            for msg in history[-10:]:
-                role = "USUÁRIO" if msg.get("role") == "user" else "ASSISTENTE"
-                content = msg.get("content", "")[:500]  # Limitar para economizar tokens
-                history_text += f"{role}: {content}\n"
+        history_text = self._format_history(history)
 
-        # Prompt completo
-        full_prompt = f"""## CONTEXTO DO DOCUMENTO
-
-**Documento:** {doc_title}
-**Total de páginas:** {page_count}
-**Categoria:** {category.value}
-
----
-
-Trechos relevantes do documento:
-
-{context}
-
----
-
-{history_text}
-
-## PERGUNTA DO USUÁRIO
-
-{query}
-
----
-
-## INSTRUÇÕES
-
-### Etapa 1: Raciocínio (Chain of Thought)
-Analise a pergunta e os trechos fornecidos seguindo estas etapas:
-
-1. **Identificação de Trechos Relevantes:**
-   - Liste os trechos que diretamente respondem à pergunta
-   - Note a página de cada trecho
-
-2. **Análise da Relação:**
-   - Explique como cada trecho se relaciona com a pergunta
-   - Identifique informações complementares ou contraditórias
-
-3. **Síntese do Raciocínio:**
-   - Combine as informações dos trechos relevantes
-   - Formule uma resposta preliminar baseada nos trechos
-
-### Etapa 2: Resposta Direta
-Com base no seu raciocínio, forneça uma resposta clara e direta ao usuário:
-
-1. **Resposta:**
-   - Responda à pergunta de forma clara e concisa
-   - Sempre cite a página no formato [Página X]
-   - Seja objetivo e direto
-
-2. **Fontes:**
-   - Liste as páginas utilizadas: [Página X], [Página Y], ...
-   - Se aplicável, identifique trechos específicos
-
-3. **Avisos:**
-   - Se houver conflitos ou informações ambíguas, mencione
-   - Se a informação não estiver completa, note o que falta
-
----
-
-**Formato da Resposta:**
-
-[RACIOCÍNIO]
-[Trechos Identificados]
-- Trecho 1 (Página X): [resumo ou citação]
-- Trecho 2 (Página Y): [resumo ou citação]
-
-[Análise da Relação]
-[Explique a conexão entre os trechos e a pergunta]
-
-[Conclusão Preliminar]
-[Resposta inicial baseada nos trechos]
-
-[RESPOSTA DIRETA]
-[Resposta clara e concisa]
-
-[Fontes]
-- [Página X]: [breve descrição do conteúdo]
-- [Página Y]: [breve descrição do conteúdo]
-
-[Avisos]
-[Quaisquer conflitos ou ambiguidades]
-
----
-
-**Responda no formato acima.**"""
+        # Prompt completo: esqueleto fixo + partes variáveis
+        prefix = self._document_prefix(doc_title, page_count, category.value,
+                                       "Trechos relevantes do documento:")
+        full_prompt = "".join((prefix, context, CHAT_CONTEXT_END, history_text,
+                               CHAT_QUERY_HEADER, query, COT_CHAT_SUFFIX))
 
         return {
             "system": system_prompt,
@@ -253,41 +318,65 @@ Com base no seu raciocínio, forneça uma resposta clara e direta ao usuário:
 
         Útil para respostas mais rápidas com menos tokens
         """
-        system_prompt = self.SYSTEM_PROMPTS.get(category, self.SYSTEM_PROMPTS[DocType.GERAL])
+        prefix = self._simple_chat_prefix(doc_title, page_count)
 
-        full_prompt = f"""## CONTEXTO DO DOCUMENTO
+        return f"{prefix}{context}{SIMPLE_CHAT_MIDDLE}{query}{SIMPLE_CHAT_SUFFIX}"
 
-**Documento:** {doc_title}
-**Total de páginas:** {page_count}
+    @staticmethod
+    def _format_history(history: Optional[Sequence[Dict[str, str]]]) -> str:
+        """Formata as últimas trocas do histórico para o prompt"""
+        if not history:
+            return ""
 
----
+        # Percorrer só a janela final, sem copiar o histórico em uma fatia
+        window = islice(history, max(0, len(history) - HISTORY_WINDOW), None)
+        format_line = PromptManager._format_history_line
+        lines = [format_line(msg.get("role"), msg.get("content", "")) for msg in window]
 
-Trechos relevantes do documento:
+        return HISTORY_HEADER + "".join(lines)
 
-{context}
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def _format_history_line(role: Optional[str], content: str) -> str:
+        """
+        Formata uma mensagem do histórico (memoizada)
 
----
+        O histórico só cresce entre turnos e cada mensagem volta nos prompts
+        das próximas trocas: só as mensagens novas são formatadas.
+        """
+        role_label = "USUÁRIO" if role == "user" else "ASSISTENTE"
+        return f"{role_label}: {content[:HISTORY_MESSAGE_CHARS]}\n"  # Limitar para economizar tokens
 
-## PERGUNTA DO USUÁRIO
+    @staticmethod
+    @lru_cache(maxsize=64)
+    def _document_prefix(doc_title: str, page_count: int, category_value: str, content_label: str) -> str:
+        """Cabeçalho do documento com categoria (memoizado por documento)"""
+        return f"""## CONTEXTO DO DOCUMENTO
 
-{query}
+**Documento:** {doc_title}
+**Total de páginas:** {page_count}
+**Categoria:** {category_value}
 
 ---
 
-## INSTRUÇÕES
+{content_label}
 
-Com base nos trechos acima, responda à pergunta do usuário:
+"""
 
-1. **Resposta:** Forneça uma resposta clara e precisa
-2. **Citação:** Sempre cite a página no formato [Página X]
-3. **Clareza:** Seja conciso mas completo
-4. **Honestidade:** Se a informação não estiver no documento, diga "Não encontrei esta informação no documento"
+    @staticmethod
+    @lru_cache(maxsize=64)
+    def _simple_chat_prefix(doc_title: str, page_count: int) -> str:
+        """Parte fixa do prompt simples por documento (memoizada)"""
+        return f"""## CONTEXTO DO DOCUMENTO
+
+**Documento:** {doc_title}
+**Total de páginas:** {page_count}
 
 ---
 
-RESPOSTA:"""
+Trechos relevantes do documento:
 
-        return full_prompt
+"""
 
     # ==========================================
     # Prompts de Resumo
@@ -335,21 +424,18 @@ RESPOSTA:"""
         Returns:
             Prompt formatado
         """
-        system_prompt = self.SYSTEM_PROMPTS.get(category, self.SYSTEM_PROMPTS[DocType.GERAL])
-
-        instructions = self.SUMMARY_INSTRUCTIONS[detail_level]
-
-        full_prompt = f"""## CONTEXTO DO DOCUMENTO
+        prefix = self._document_prefix(doc_title, page_count, category.value,
+                                       "Conteúdo do documento:")
 
-**Documento:** {doc_title}
-**Total de páginas:** {page_count}
-**Categoria:** {category.value}
+        return "".join((prefix, content, self._summary_suffix(doc_title, detail_level)))
 
----
-
-Conteúdo do documento:
+    @staticmethod
+    @lru_cache(maxsize=64)
+    def _summary_suffix(doc_title: str, detail_level: DetailLevel) -> str:
+        """Instruções do resumo por documento e nível de detalhe (memoizadas)"""
+        instructions = PromptManager.SUMMARY_INSTRUCTIONS[detail_level]
 
-{content}
+        return f"""
 
 ---
 
@@ -383,8 +469,6 @@ Crie um resumo do documento acima seguindo estas diretrizes:
 
 RESUMO:"""
 
-        return full_prompt
-
     # ==========================================
     # Prompts RAPTOR
     # ==========================================
@@ -413,27 +497,34 @@ RESUMO:"""
         Returns:
             Prompt formatado
         """
-        level_desc = self.RAPTOR_LEVEL_DESCRIPTIONS.get(
-            level,
-            f"nível {level} de síntese"
-        )
+        task, response_format = self._raptor_parts(level)
 
         # Format chunks
-        chunks_formatted = "\n\n".join([
-            f"[Trecho {i+1}] {chunk}"
-            for i, chunk in enumerate(chunks)
-        ])
+        chunks_formatted = "\n\n".join(
+            f"[Trecho {i}] {chunk}"
+            for i, chunk in enumerate(chunks, 1)
+        )
 
-        full_prompt = f"""Você é um assistente especializado em criar sínteses hierárquicas de documentos.
+        return "".join((RAPTOR_PROMPT_HEAD, context, task, chunks_formatted, response_format))
 
-### Contexto
-{context}
+    @staticmethod
+    @lru_cache(maxsize=16)
+    def _raptor_parts(level: int) -> Tuple[str, str]:
+        """Partes do prompt RAPTOR que dependem só do nível (memoizadas)"""
+        level_desc = PromptManager.RAPTOR_LEVEL_DESCRIPTIONS.get(
+            level,
+            f"nível {level} de síntese"
+        )
+
+        task = f"""
 
 ### Tarefa
 Crie uma síntese dos trechos abaixo no nível {level}: {level_desc}
 
 ### Conteúdo
-{chunks_formatted}
+"""
+
+        response_format = f"""
 
 ### Instruções
 1. Identifique os temas comuns entre os trechos
@@ -453,7 +544,7 @@ Crie uma síntese dos trechos abaixo no nível {level}: {level_desc}
 
 SÍNTESE:"""
 
-        return full_prompt
+        return task, response_format
 
     # ==========================================
     # Few-Shot Examples
@@ -549,60 +640,16 @@ Nenhum."""
         Returns:
             Prompt com exemplos few-shot
         """
-        system_prompt = self.SYSTEM_PROMPTS.get(category, self.SYSTEM_PROMPTS[DocType.GERAL])
-
         # Obter exemplos few-shot para categoria
         examples = self.CHAT_EXAMPLES.get(category, "")
 
         # Histórico formatado
-        history_text = ""
-        if history:
-            history_text = "\n\nHistórico de conversa (últimas 10 trocas):\n"
-            for msg in history[-10:]:
-                role = "USUÁRIO" if msg.get("role") == "user" else "ASSISTENTE"
-                content = msg.get("content", "")[:500]
-                history_text += f"{role}: {content}\n"
-
-        # Prompt completo
-        full_prompt = f"""{examples}
-
----
-
-## CONTEXTO DO DOCUMENTO
-
-**Documento:** {doc_title}
-**Total de páginas:** {page_count}
-
----
-
-Trechos relevantes do documento:
-
-{context}
-
----
+        history_text = self._format_history(history)
 
-{history_text}
-
-## PERGUNTA DO USUÁRIO
-
-{query}
-
----
-
-## INSTRUÇÕES
-
-Com base nos trechos acima e seguindo o exemplo fornecido, responda à pergunta do usuário:
-
-1. **Raciocínio:** Analise os trechos relevantes e explique seu raciocínio
-2. **Resposta:** Forneça uma resposta clara e precisa
-3. **Citação:** Sempre cite a página no formato [Página X]
-4. **Formato:** Siga o formato do exemplo acima ([RACIOCÍNIO] e [RESPOSTA DIRETA])
-
----
-
-RESPOSTA:"""
-
-        return full_prompt
+        # Prompt completo: esqueleto fixo + partes variáveis
+        return "".join((examples, CHAT_CONTEXT_END, self._simple_chat_prefix(doc_title, page_count),
+                        context, CHAT_CONTEXT_END, history_text,
+                        CHAT_QUERY_HEADER, query, FEWSHOT_CHAT_SUFFIX))
 
     # ==========================================
     # Validação de Resposta
@@ -629,8 +676,11 @@ RESPOSTA:"""
         warnings = []
         score = 0
 
-        # Verifica se cita páginas
-        has_page_citation = "[Página" in response or "página" in response.lower()
+        # Caixa baixa calculada uma única vez para todas as verificações
+        response_lower = response.lower()
+
+        # Verifica se cita páginas ("[Página X]" também contém "página")
+        has_page_citation = "página" in response_lower
         if not has_page_citation:
             issues.append("Resposta não cita páginas do documento")
         else:
@@ -646,7 +696,6 @@ RESPOSTA:"""
 
         # Verifica se responde à pergunta
         query_lower = query.lower()
-        response_lower = response.lower()
 
         # Palavras-chave da query (primeiras 3)
         query_keywords = [word for word in query_lower.split() if len(word) > 3][:3]
@@ -660,11 +709,9 @@ RESPOSTA:"""
         else:
             warnings.append(f"Resposta parcial: {keywords_found}/{len(query_keywords)} palavras-chave encontradas")
 
-        # Verifica se usa apenas contexto
-        if "não encontrei" in response.lower() and chunks:
-            # Se há chunks mas não encontrou, pode estar ok
-            score += 20
-        elif chunks and "não encontrei" not in response.lower():
+        # Verifica se usa apenas contexto: havendo chunks, tanto a resposta
+        # baseada neles quanto um "não encontrei" explícito estão ok
+        if chunks:
             score += 20
 
         # Classificar qualidade
@@ -701,23 +748,31 @@ RESPOSTA:"""
         Returns:
             Chunks formatados para o prompt
         """
-        formatted = []
-        for i, chunk in enumerate(chunks, 1):
-            page = chunk.get("metadata", {}).get("page", "N/A")
+        def format_chunk(i: int, chunk: Dict[str, Any]) -> str:
+            metadata = chunk.get("metadata")
+            page = metadata.get("page", "N/A") if metadata else "N/A"
             text = chunk.get("text", "")
 
-            # Truncar se necessário
+            # Truncar só se necessário (evita copiar trechos curtos)
             if len(text) > max_per_chunk:
                 text = text[:max_per_chunk] + "..."
 
-            formatted.append(f"[Trecho {i} - Página {page}]\n{text}")
+            return f"[Trecho {i} - Página {page}]\n{text}"
 
-        return "\n\n".join(formatted)
+        return "\n\n".join(format_chunk(i, chunk) for i, chunk in enumerate(chunks, 1))
 
     @staticmethod
     def estimate_tokens(text: str) -> int:
+        """Conta os tokens de um texto com o tokenizer"""
+        if not text:
+            return 0
+
+        return _count_tokens(text)
+
+    @staticmethod
+    def estimate_tokens_fast(text: str) -> int:
         """
-        Estima número de tokens em um texto
+        Estima número de tokens em um texto sem tokenizar
         Aproximação: 1 token ≈ 4 caracteres para português
         """
         return len(text) // 4
@@ -5,24 +5,268 @@
 # ==========================================
 
 from typing import List, Dict, Any, Optional, Tuple
-from collections import defaultdict
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+from functools import lru_cache
+from operator import itemgetter
+import hashlib
+import heapq
+import os
+import queue
+import sys
+import threading
+import time
 import numpy as np
 import faiss
+from diskcache import Cache
+from scipy import sparse
+from sklearn.feature_extraction.text import HashingVectorizer
 
-from sentence_transformers import SentenceTransformer
+from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
 
 from app.config import settings
 from app.models import DocumentMetadata, SearchRequest, SearchResult
 
 
+# Número máximo de buscas mantidas em cache
+SEARCH_CACHE_SIZE = 256
+
+# Tamanho dos lotes (textos de comprimento parecido) enviados ao modelo de embeddings
+EMBED_BATCH_SIZE = 32
+
+# Faixas de tamanho em tokens e o lote usado em cada uma (textos curtos, lotes maiores)
+EMBED_BUCKETS = ((32, 128), (64, 64), (128, 32), (256, 16), (512, 16))
+
+# Textos tokenizados por vez ao medir o tamanho (o lock do modelo é liberado entre fatias)
+TOKENIZE_SLICE = 128
+
+# Cache em disco de embeddings (chave: hash do modelo + texto)
+EMBED_CACHE_DIR = "emb_cache"
+EMBED_CACHE_SIZE_LIMIT = 1024 ** 3
+
+# Fração de linhas removidas (tombstones) a partir da qual o índice é compactado
+COMPACT_DEAD_FRACTION = 0.5
+
+# Embeddings originais (float16, memmap) guardados para rerank e reconstrução do índice
+VECTORS_FILE = "vectors.f16"
+MIN_VECTOR_CAPACITY = 1024
+
+# Máximo de vetores usados para treinar o índice aproximado
+ANN_TRAIN_SIZE = 100000
+
+# Busca por palavra-chave (BM25): colunas do vetorizador de termos e parâmetros
+KEYWORD_FEATURES = 2 ** 20
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# Micro-batching de queries concorrentes: espera máxima (s) e tamanho máximo do lote
+QUERY_BATCH_WAIT = 0.005
+QUERY_BATCH_SIZE = 8
+
+
+def _quantized_onnx_files(model_dir) -> List:
+    return sorted((model_dir / "onnx").glob(f"model_*{settings.huggingface_quantization}*.onnx"))
+
+
+@lru_cache(maxsize=1)
+def get_embeddings_model() -> SentenceTransformer:
+    """
+    Carrega o modelo de embeddings (uma instância compartilhada por RAG e RAPTOR)
+
+    Com o backend "onnx" o modelo roda no ONNX Runtime em vez do PyTorch; se
+    houver quantização configurada, a versão int8 é exportada uma única vez
+    para indexes/models e reaproveitada nas próximas execuções.
+    """
+    if settings.huggingface_backend != "onnx":
+        return SentenceTransformer(settings.huggingface_model, device=settings.huggingface_device)
+
+    if not settings.huggingface_quantization:
+        return SentenceTransformer(settings.huggingface_model, device=settings.huggingface_device,
+                                   backend="onnx")
+
+    model_dir = settings.indexes_path / "models" / settings.huggingface_model.replace("/", "__")
+    quantized = _quantized_onnx_files(model_dir)
+
+    if not quantized:
+        print(f"  Exportando modelo ONNX int8 ({settings.huggingface_quantization}) para {model_dir}...")
+        model = SentenceTransformer(settings.huggingface_model, device=settings.huggingface_device,
+                                    backend="onnx")
+        model.save(str(model_dir))
+        export_dynamic_quantized_onnx_model(model, settings.huggingface_quantization, str(model_dir))
+        quantized = _quantized_onnx_files(model_dir)
+
+    return SentenceTransformer(
+        str(model_dir),
+        device=settings.huggingface_device,
+        backend="onnx",
+        model_kwargs={"file_name": str(quantized[0].relative_to(model_dir))}
+    )
+
+
+@lru_cache(maxsize=64)
+def _rrf_weights(k: int, n: int) -> Tuple[float, ...]:
+    """Pesos 1 / (k + rank) do RRF para as posições 1..n"""
+    return tuple(1 / (k + rank) for rank in range(1, n + 1))
+
+
+def _top_normalized(scores: Dict[str, float], top_k: Optional[int]) -> List[Tuple[str, float]]:
+    """Ordena os scores (só os top_k, se dado) e normaliza pelo maior"""
+    if not scores:
+        return []
+
+    if top_k is None:
+        combined = sorted(scores.items(), key=itemgetter(1), reverse=True)
+    else:
+        combined = heapq.nlargest(top_k, scores.items(), key=itemgetter(1))
+
+    max_score = combined[0][1]
+    return [(doc_id, score / max_score) for doc_id, score in combined]
+
+
+def _copy_results(results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Cópia dos resultados do cache: quem chama pode alterá-los livremente"""
+    return [{**result, "metadata": dict(result["metadata"])} for result in results]
+
+
+class QueryBatcher:
+    """
+    Agrupa queries concorrentes em uma única chamada ao modelo de embeddings
+
+    Uma thread em segundo plano junta as queries que chegam em até
+    QUERY_BATCH_WAIT segundos (ou QUERY_BATCH_SIZE queries) e as codifica
+    de uma vez.
+    """
+
+    def __init__(self, embed_batch):
+        self._embed_batch = embed_batch
+        self._queue: "queue.Queue[Tuple[str, Future]]" = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def embed(self, text: str) -> np.ndarray:
+        """Retorna o embedding normalizado de uma query"""
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="query-batcher", daemon=True)
+                    self._thread.start()
+
+        future = Future()
+        self._queue.put((text, future))
+        return future.result()
+
+    def _run(self):
+        while True:
+            pending = [self._queue.get()]
+            deadline = time.monotonic() + QUERY_BATCH_WAIT
+
+            while len(pending) < QUERY_BATCH_SIZE:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    pending.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            try:
+                embeddings = self._embed_batch([text for text, _ in pending])
+            except Exception as e:
+                for _, future in pending:
+                    future.set_exception(e)
+                continue
+
+            for (_, future), embedding in zip(pending, embeddings):
+                future.set_result(embedding)
+
+
+class ReadWriteLock:
+    """
+    Lock de leitura/escrita: várias buscas ao mesmo tempo, alterações exclusivas
+
+    Escritores em espera têm prioridade sobre novas leituras, para que um
+    fluxo contínuo de buscas não atrase a indexação. Não é reentrante.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._readers = 0
+        self._writing = False
+        self._waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        with self._condition:
+            while self._writing or self._waiting_writers:
+                self._condition.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._condition:
+            self._waiting_writers += 1
+            while self._writing or self._readers:
+                self._condition.wait()
+            self._waiting_writers -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writing = False
+                self._condition.notify_all()
+
+
 class RAGService:
     """Serviço de Retrieval-Augmented Generation com busca híbrida e RAPTOR usando FAISS"""
 
     def __init__(self):
         self.embeddings_model = None
+        self.embedding_dim = 0
         self.vector_index = None
-        self.documents_metadata = {}  # Mapeia doc_id -> (text, metadata)
-        self.doc_ids_list = []  # Lista ordenada de IDs para conversão FAISS -> metadados
+        self._vectors = np.empty((0, 0), dtype=np.float16)  # Embeddings originais, uma linha por vetor do índice
+        self._n_vectors = 0
+        self._alive = np.zeros(0, dtype=bool)  # Linhas ainda válidas (remoção = tombstone)
+        self._n_dead = 0
+        self._vectorizer = HashingVectorizer(n_features=KEYWORD_FEATURES, token_pattern=r"(?u)\b\w+\b",
+                                             alternate_sign=False, norm=None)
+        self._term_matrix = None  # Frequência dos termos (CSC), uma linha por vetor do índice
+        self._term_blocks: List[sparse.csr_matrix] = []  # Linhas ainda não incorporadas à matriz
+        self._doc_lengths = np.empty(0, dtype=np.float32)
+        self._doc_freq = np.zeros(KEYWORD_FEATURES, dtype=np.int64)
+        self._keyword_lock = threading.Lock()
+        # Chunks em listas/arrays paralelos, indexados pela linha do índice FAISS
+        # (o dict de metadados só é montado ao devolver o chunk)
+        self.doc_ids_list: List[str] = []  # ID de cada chunk
+        self._texts: List[str] = []
+        self._row_documents: List[str] = []  # ID do documento (string interna, compartilhada)
+        self._pages = np.zeros(0, dtype=np.int32)
+        self._chunk_indexes = np.zeros(0, dtype=np.int32)
+        self._text_lengths = np.zeros(0, dtype=np.int32)
+        self._extra_metadata: Dict[int, Dict[str, Any]] = {}  # Linha -> metadados extras do chunk
+        self._chunk_rows: Dict[str, int] = {}  # ID do chunk -> linha
+        self._document_rows: Dict[str, List[int]] = {}  # ID do documento -> linhas dos seus chunks
+        # Buscas leem o índice e as listas sob _rows_lock.read(); alterações são
+        # publicadas sob _rows_lock.write(). _write_lock serializa quem altera o índice
+        self._rows_lock = ReadWriteLock()
+        self._write_lock = threading.Lock()
+        self._search_cache = OrderedDict()  # (doc, hash da query, top_k, rrf) -> (timestamp, resultados)
+        self._search_cache_lock = threading.Lock()
+        # Documento (None = todos) -> nº de alterações publicadas; buscas que viram
+        # uma alteração no meio do caminho não vão para o cache
+        self._generations: Dict[Optional[str], int] = {}
+        self._emb_cache = None
+        self._emb_cache_prefix = b""
+        self._encode_lock = threading.Lock()  # O tokenizer do modelo não aceita chamadas concorrentes
+        self._query_batcher = QueryBatcher(self._encode)
         self.initialized = False
 
     def initialize(self):
@@ -33,64 +277,192 @@ class RAGService:
         print(f"Inicializando RAG Service (FAISS)...")
         print(f"  Embeddings model: {settings.huggingface_model}")
         print(f"  Device: {settings.huggingface_device}")
+        print(f"  Backend: {settings.huggingface_backend}")
 
         # Carregar modelo de embeddings
-        self.embeddings_model = SentenceTransformer(
-            settings.huggingface_model,
-            device=settings.huggingface_device
-        )
+        self.embeddings_model = get_embeddings_model()
 
         # Inicializar FAISS Index (L2 distance = Inner Product para embeddings normalizados)
-        embedding_dim = self.embeddings_model.get_sentence_embedding_dimension()
-        self.vector_index = faiss.IndexFlatIP(embedding_dim)
+        self.embedding_dim = self.embeddings_model.get_sentence_embedding_dimension()
+        self.vector_index = self._build_index(np.empty((0, self.embedding_dim), dtype=np.float32))
+        self._vectors = self._new_vectors_file(np.empty((0, self.embedding_dim), dtype=np.float16),
+                                               MIN_VECTOR_CAPACITY)
+        self._alive = np.zeros(MIN_VECTOR_CAPACITY, dtype=bool)
+        self._pages, self._chunk_indexes, self._text_lengths = (
+            np.zeros(MIN_VECTOR_CAPACITY, dtype=np.int32) for _ in range(3))
+
+        # Cache de embeddings já calculados (sobrevive a reinícios e reindexações)
+        self._emb_cache = Cache(str(settings.indexes_path / EMBED_CACHE_DIR),
+                                size_limit=EMBED_CACHE_SIZE_LIMIT)
+        self._emb_cache_prefix = (f"{settings.huggingface_model}|{settings.huggingface_backend}|"
+                                  f"{settings.huggingface_quantization}|").encode("utf-8")
 
         self.initialized = True
         print("RAG Service inicializado com sucesso (FAISS)!")
 
-    def embed_text(self, text: str) -> List[float]:
-        """Gera embedding para um texto"""
+    def embed_batch(self, texts: List[str]) -> np.ndarray:
+        """
+        Gera embeddings normalizados (float32, N x d) para vários textos
+
+        Textos já codificados vêm do cache em disco; só os demais (sem
+        repetição) passam pelo modelo.
+        """
         if not self.initialized:
             self.initialize()
 
-        embedding = self.embeddings_model.encode(text, convert_to_numpy=True)
-        
-        # Normalizar embeddings (L2 normalization)
-        embedding = embedding / np.linalg.norm(embedding)
-        return embedding.tolist()
+        embeddings = np.empty((len(texts), self.embedding_dim), dtype=np.float32)
+        misses: Dict[bytes, List[int]] = {}
+
+        for i, text in enumerate(texts):
+            key = hashlib.sha256(self._emb_cache_prefix + text.encode("utf-8")).digest()[:16]
+            cached = self._emb_cache.get(key)
+            if cached is None:
+                misses.setdefault(key, []).append(i)
+            else:
+                embeddings[i] = np.frombuffer(cached, dtype=np.float32)
+
+        if misses:
+            rows = list(misses.values())
+            encoded = self._encode([texts[positions[0]] for positions in rows])
+
+            with self._emb_cache.transact():
+                for key, positions, embedding in zip(misses, rows, encoded):
+                    embeddings[positions] = embedding
+                    self._emb_cache.set(key, embedding.tobytes())
+
+        return embeddings
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        """
+        Codifica textos com o modelo, sem cache
+
+        Os lotes saem de _bucketize (textos de tamanho parecido, com pouco
+        padding); o resultado volta na ordem original. O lock é tomado por
+        lote: queries concorrentes esperam no máximo um lote.
+        """
+        if not self.initialized:
+            self.initialize()
+
+        embeddings = np.empty((len(texts), self.embedding_dim), dtype=np.float32)
+
+        for batch, batch_size in self._bucketize(texts):
+            batch_texts = [texts[i] for i in batch]
+
+            with self._encode_lock:
+                embeddings[batch] = self.embeddings_model.encode(
+                    batch_texts,
+                    batch_size=batch_size,
+                    convert_to_numpy=True,
+                    normalize_embeddings=True
+                )
+
+        return embeddings
+
+    def _bucketize(self, texts: List[str]) -> List[Tuple[np.ndarray, int]]:
+        """
+        Separa os textos em lotes (índices, tamanho do lote) por faixa de
+        tamanho em tokens (EMBED_BUCKETS)
 
-    def add_documents(self, chunks: List[Dict[str, Any]], document_id: str):
-        """Adiciona chunks de documento ao índice vetorial FAISS"""
+        Cada lote é completado com padding só até o maior texto da sua faixa,
+        e faixas de textos curtos usam lotes maiores.
+        """
+        if len(texts) <= 1:
+            return [(np.arange(len(texts)), EMBED_BATCH_SIZE)]
+
+        # Em fatias: uma query concorrente não espera a tokenização do lote inteiro
+        lengths = np.empty(len(texts), dtype=np.int64)
+        for start in range(0, len(texts), TOKENIZE_SLICE):
+            with self._encode_lock:
+                lengths[start:start + TOKENIZE_SLICE] = self.embeddings_model.tokenizer(
+                    texts[start:start + TOKENIZE_SLICE],
+                    truncation=True,
+                    max_length=self.embeddings_model.max_seq_length,
+                    return_length=True
+                )["length"]
+
+        order = np.argsort(lengths, kind="stable")
+        limits = np.array([limit for limit, _ in EMBED_BUCKETS])
+        buckets = np.minimum(np.searchsorted(limits, lengths[order]), len(EMBED_BUCKETS) - 1)
+
+        lots = []
+        for bucket in np.unique(buckets):
+            rows = order[buckets == bucket]
+            batch_size = EMBED_BUCKETS[bucket][1]
+            lots.extend((rows[start:start + batch_size], batch_size)
+                        for start in range(0, len(rows), batch_size))
+
+        return lots
+
+    def embed_query(self, text: str) -> np.ndarray:
+        """Gera o embedding normalizado de uma query (agrupada com queries concorrentes)"""
         if not self.initialized:
             self.initialize()
 
-        ids = [f"{document_id}_{i}" for i in range(len(chunks))]
+        return self._query_batcher.embed(text)
+
+    def embed_text(self, text: str) -> List[float]:
+        """Gera embedding para um texto"""
+        return self.embed_query(text).tolist()
+
+    def add_documents(self, chunks: List[Dict[str, Any]], document_id: str, start_index: int = 0):
+        """
+        Adiciona chunks de documento ao índice vetorial FAISS
+
+        start_index permite adicionar um documento em lotes sucessivos sem
+        repetir IDs de chunk.
+        """
+        if not self.initialized:
+            self.initialize()
+
+        document_id = sys.intern(document_id)
+        ids = [f"{document_id}_{start_index + i}" for i in range(len(chunks))]
         texts = [chunk["text"] for chunk in chunks]
-        metadatas = [
-            {
-                "document_id": document_id,
-                "page": chunk["page"],
-                "chunk_index": i,
-                "text_length": len(chunk["text"]),
-                **chunk.get("metadata", {})
-            }
-            for i, chunk in enumerate(chunks)
-        ]
-
-        # Gerar embeddings normalizados
-        embeddings = self.embeddings_model.encode(texts, convert_to_numpy=True)
-        embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
-
-        # Armazenar metadados (text original e metadados)
-        for doc_id, text, metadata in zip(ids, texts, metadatas):
-            self.documents_metadata[doc_id] = {
-                "text": text,
-                "metadata": metadata
-            }
-            if doc_id not in self.doc_ids_list:
-                self.doc_ids_list.append(doc_id)
-
-        # Adicionar embeddings ao índice FAISS
-        self.vector_index.add(embeddings)
+
+        # Gerar embeddings normalizados e a frequência dos termos (fora dos locks)
+        embeddings = self.embed_batch(texts)
+        terms = self._vectorizer.transform(texts).tocsr()
+
+        with self._write_lock:
+            with self._rows_lock.write():
+                # Chunks reenviados (mesmo ID): a linha anterior vira tombstone
+                replaced = [self._chunk_rows[chunk_id] for chunk_id in ids if chunk_id in self._chunk_rows]
+                if replaced:
+                    self._alive[replaced] = False
+                    self._n_dead += len(replaced)
+                    replaced_rows = set(replaced)
+                    self._document_rows[document_id] = [row for row in self._document_rows[document_id]
+                                                        if row not in replaced_rows]
+                    for row in replaced:
+                        self._extra_metadata.pop(row, None)
+
+                # Adicionar embeddings ao índice FAISS e os termos à busca por palavra-chave
+                rows = range(self._n_vectors, self._n_vectors + len(ids))
+                self._append_vectors(embeddings)
+                self._pages[rows.start:rows.stop] = [chunk["page"] for chunk in chunks]
+                self._chunk_indexes[rows.start:rows.stop] = np.arange(start_index, start_index + len(ids))
+                self._text_lengths[rows.start:rows.stop] = [len(text) for text in texts]
+                self.vector_index.add(embeddings)
+                self._append_terms(terms)
+
+                # Armazenar texto original e metadados; por último os mapas de
+                # linhas, que só podem apontar para linhas já guardadas
+                self.doc_ids_list.extend(ids)
+                self._texts.extend(texts)
+                self._row_documents.extend([document_id] * len(ids))
+                self._extra_metadata.update((row, chunk["metadata"]) for row, chunk in zip(rows, chunks)
+                                            if chunk.get("metadata"))
+                self._chunk_rows.update(zip(ids, rows))
+                self._document_rows.setdefault(document_id, []).extend(rows)
+                self._bump_generation(document_id)
+
+            # Corpus cresceu além do limiar: trocar a busca exata pelo índice aproximado
+            if self._is_exhaustive() and self._n_vectors >= settings.vector_ann_threshold:
+                print(f"Construindo índice aproximado {settings.vector_index_factory} ({self._n_vectors} vetores)...")
+                vector_index = self._build_index(self._vectors[:self._n_vectors])
+                with self._rows_lock.write():
+                    self.vector_index = vector_index
+
+        self._invalidate_search_cache(document_id)
         
         print(f"Adicionados {len(chunks)} chunks ao índice FAISS para documento {document_id}")
 
@@ -100,90 +472,219 @@ class RAGService:
         if not self.initialized:
             self.initialize()
 
-        # Gerar embedding da query normalizada
-        query_embedding = self.embeddings_model.encode(query, convert_to_numpy=True)
-        query_embedding = query_embedding / np.linalg.norm(query_embedding)
-
-        # Buscar no FAISS
-        k = min(top_k * 10, self.vector_index.ntotal)  # Buscar mais candidatos para RRF
-        scores, indices = self.vector_index.search(query_embedding, k)
+        # Gerar embedding da query normalizada (fora do lock: pode esperar o modelo)
+        query_embedding = self.embed_query(query).reshape(1, -1)
+
+        with self._rows_lock.read():
+            return self._vector_search(query_embedding, top_k, document_id)
+
+    def _vector_search(self, query_embedding: np.ndarray, top_k: int,
+                       document_id: Optional[str]) -> List[Tuple[str, float]]:
+        if document_id:
+            # Só os chunks do documento: produto interno direto com os embeddings guardados
+            rows = np.asarray(self._document_rows.get(document_id, []), dtype=np.int64)
+            k = min(top_k * 10, len(rows))  # Buscar mais candidatos para RRF
+            if k == 0:
+                return []
+
+            exact = self._vectors[rows] @ query_embedding[0]
+            order = np.argpartition(-exact, k - 1)[:k]
+            order = order[np.argsort(-exact[order], kind="stable")]
+            return [(self.doc_ids_list[row], float(score)) for row, score in zip(rows[order], exact[order])]
+
+        k = min(top_k * 10, self.vector_index.ntotal - self._n_dead)  # Buscar mais candidatos para RRF
+        if k <= 0:
+            return []
+
+        # Buscar no FAISS, com folga para as linhas removidas (descartadas aqui)
+        if self._is_exhaustive():
+            scores, indices = self.vector_index.search(query_embedding, k + self._n_dead)
+            alive = self._alive[indices[0]] & (indices[0] >= 0)
+            scores, indices = scores[0][alive][:k], indices[0][alive][:k]
+        else:
+            # Índice aproximado: reordenar os candidatos com os embeddings originais
+            n_candidates = min(max(k, settings.vector_rerank_k) + self._n_dead, self.vector_index.ntotal)
+            _, candidates = self.vector_index.search(query_embedding, n_candidates)
+            candidates = candidates[0][candidates[0] >= 0]
+            candidates = candidates[self._alive[candidates]]
+            exact = self._vectors[candidates] @ query_embedding[0]
+            order = np.argsort(-exact)[:k]
+            scores, indices = exact[order], candidates[order]
 
         # Mapear FAISS indices -> doc_ids
         results = []
-        for i in range(len(indices)):
-            idx = indices[i]
-            if idx < len(self.doc_ids_list):
+        for idx, score in zip(indices, scores):
+            if 0 <= idx < len(self.doc_ids_list):
                 doc_id = self.doc_ids_list[idx]
-                # Converter score de inner product para similaridade (cosine)
                 # Para embeddings normalizados, inner product = cos similarity
-                score = float(scores[i])
-                results.append((doc_id, score))
+                results.append((doc_id, float(score)))
 
         return results
 
+    def _is_exhaustive(self) -> bool:
+        """Se o índice atual compara a query com todos os vetores (não é aproximado)"""
+        return isinstance(self.vector_index, (faiss.IndexFlat, faiss.IndexScalarQuantizer))
+
+    def _new_vectors_file(self, vectors: np.ndarray, capacity: int) -> np.memmap:
+        """Cria o arquivo de embeddings com os vetores dados, substituindo o anterior"""
+        path = settings.indexes_path / VECTORS_FILE
+        tmp_path = path.with_name(path.name + ".tmp")
+
+        stored = np.memmap(tmp_path, dtype=np.float16, mode="w+", shape=(capacity, self.embedding_dim))
+        stored[:len(vectors)] = vectors
+        stored.flush()
+
+        # Buscas em andamento continuam lendo o mapeamento do arquivo anterior
+        os.replace(tmp_path, path)
+        return stored
+
+    def _append_vectors(self, embeddings: np.ndarray):
+        """Guarda os embeddings originais em float16 (arquivo com crescimento geométrico)"""
+        n_vectors = self._n_vectors + len(embeddings)
+
+        if n_vectors > len(self._vectors):
+            capacity = max(n_vectors, 2 * len(self._vectors))
+            path = settings.indexes_path / VECTORS_FILE
+            self._vectors.flush()
+            os.truncate(path, capacity * self.embedding_dim * np.dtype(np.float16).itemsize)
+            self._vectors = np.memmap(path, dtype=np.float16, mode="r+",
+                                      shape=(capacity, self.embedding_dim))
+            self._alive = self._resized(self._alive, capacity)
+            self._pages = self._resized(self._pages, capacity)
+            self._chunk_indexes = self._resized(self._chunk_indexes, capacity)
+            self._text_lengths = self._resized(self._text_lengths, capacity)
+
+        self._vectors[self._n_vectors:n_vectors] = embeddings
+        self._alive[self._n_vectors:n_vectors] = True
+        self._n_vectors = n_vectors
+
+    def _resized(self, array: np.ndarray, capacity: int) -> np.ndarray:
+        """Cópia do array de linhas com nova capacidade (linhas novas zeradas)"""
+        resized = np.zeros(capacity, dtype=array.dtype)
+        resized[:self._n_vectors] = array[:self._n_vectors]
+        return resized
+
+    def _append_terms(self, block: sparse.csr_matrix):
+        """Acrescenta a frequência dos termos (uma linha por chunk) à matriz da busca por palavra-chave"""
+        with self._keyword_lock:
+            self._term_blocks.append(block)
+            self._doc_freq += np.bincount(block.indices, minlength=KEYWORD_FEATURES)
+
+    def _keyword_matrix(self) -> Optional[sparse.csc_matrix]:
+        """Matriz de termos com todas as linhas (incorpora os blocos pendentes)"""
+        with self._keyword_lock:
+            if self._term_blocks:
+                blocks = self._term_blocks if self._term_matrix is None else [self._term_matrix, *self._term_blocks]
+                lengths = [np.asarray(block.sum(axis=1), dtype=np.float32).ravel() for block in self._term_blocks]
+                self._term_matrix = sparse.vstack(blocks, format="csc")
+                self._doc_lengths = np.concatenate([self._doc_lengths, *lengths])
+                self._term_blocks = []
+
+            return self._term_matrix
+
+    def _build_index(self, vectors: np.ndarray):
+        """
+        Cria um índice FAISS com os vetores dados
+
+        Busca exata (vector_flat_index) até vector_ann_threshold vetores;
+        acima disso, o índice aproximado de vector_index_factory, treinado
+        com uma amostra de até ANN_TRAIN_SIZE vetores.
+        """
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+
+        if len(vectors) < settings.vector_ann_threshold:
+            index = faiss.index_factory(self.embedding_dim, settings.vector_flat_index,
+                                        faiss.METRIC_INNER_PRODUCT)
+        else:
+            index = faiss.index_factory(self.embedding_dim, settings.vector_index_factory,
+                                        faiss.METRIC_INNER_PRODUCT)
+            if not index.is_trained:
+                sample = vectors
+                if len(vectors) > ANN_TRAIN_SIZE:
+                    rows = np.random.default_rng(42).choice(len(vectors), ANN_TRAIN_SIZE, replace=False)
+                    sample = vectors[np.sort(rows)]
+                index.train(sample)
+            if "IVF" in settings.vector_index_factory:
+                faiss.extract_index_ivf(index).nprobe = settings.vector_nprobe
+
+        index.add(vectors)
+        return index
+
     def keyword_search(self, query: str, top_k: int = 5,
                        document_id: Optional[str] = None) -> List[Tuple[str, float]]:
-        """Busca por palavra-chave usando simulação BM25"""
+        """
+        Busca por palavra-chave usando BM25
+
+        Os chunks ficam em uma matriz esparsa de frequência de termos; a
+        pontuação de todos eles sai de operações vetorizadas sobre as
+        colunas dos termos da query.
+        """
         if not self.initialized:
             self.initialize()
 
-        query_terms = query.lower().split()
-        scored_results = []
+        query_terms = np.unique(self._vectorizer.transform([query]).indices)
 
-        # Simular BM25 scoring nos documentos armazenados
-        for doc_id, data in self.documents_metadata.items():
-            if document_id and not doc_id.startswith(document_id):
-                continue
-                
-            text = data["text"].lower()
-            
-            # Calcular relevância baseada na presença de termos
-            score = 0
-            for term in query_terms:
-                if term in text:
-                    score += 1
-                    # Bônus para termos exatos
-                    if f" {term} " in f" {text} ":
-                        score += 0.5
-
-            if score > 0:
-                scored_results.append((doc_id, score))
-
-        # Ordenar por relevância e normalizar
-        if scored_results:
-            max_score = max(score for _, score in scored_results)
-            scored_results = [(doc_id, score / max_score) for doc_id, score in scored_results]
-            scored_results.sort(key=lambda x: x[1], reverse=True)
-
-        return scored_results[:top_k]
+        with self._rows_lock.read():
+            return self._keyword_search(query_terms, top_k, document_id)
+
+    def _keyword_search(self, query_terms: np.ndarray, top_k: int,
+                        document_id: Optional[str]) -> List[Tuple[str, float]]:
+        term_matrix = self._keyword_matrix()
+
+        if term_matrix is None or not term_matrix.shape[0] or not len(query_terms):
+            return []
+
+        n_docs = term_matrix.shape[0]
+        doc_freq = self._doc_freq[query_terms]
+        idf = np.log(1 + (n_docs - doc_freq + 0.5) / (doc_freq + 0.5))
+
+        # Frequência dos termos da query em cada chunk (uma coluna por termo)
+        postings = term_matrix[:, query_terms]
+        rows = postings.indices
+        tf = postings.data.astype(np.float32)
+        term_idf = np.repeat(idf, np.diff(postings.indptr))
+
+        length_norm = BM25_K1 * (1 - BM25_B + BM25_B * self._doc_lengths[rows] / self._doc_lengths.mean())
+        scores = np.bincount(rows, weights=term_idf * tf * (BM25_K1 + 1) / (tf + length_norm),
+                             minlength=n_docs)
+
+        if document_id:
+            rows = np.asarray(self._document_rows.get(document_id, []), dtype=np.int64)
+            matches = rows[scores[rows] > 0]
+        else:
+            matches = np.flatnonzero((scores > 0) & self._alive[:n_docs])
+
+        if not len(matches):
+            return []
+
+        # Ordenar por relevância (só os top_k) e normalizar
+        max_score = scores[matches].max()
+        if len(matches) > top_k:
+            matches = matches[np.argpartition(-scores[matches], top_k - 1)[:top_k]]
+        matches = matches[np.argsort(-scores[matches], kind="stable")]
+
+        return [(self.doc_ids_list[i], float(scores[i] / max_score)) for i in matches]
 
     def reciprocal_rank_fusion(self, vector_results: List[Tuple[str, float]],
                               keyword_results: List[Tuple[str, float]],
-                              k: int = 60) -> List[Tuple[str, float]]:
+                              k: int = 60,
+                              top_k: Optional[int] = None) -> List[Tuple[str, float]]:
         """
         Combina resultados de busca vetorial e por palavra-chave usando Reciprocal Rank Fusion
 
         Fórmula: score = Σ(1 / (k + rank)) para cada ranqueamento
+        Com top_k, só os top_k melhores são ordenados e retornados.
         """
-        scores = defaultdict(float)
+        weights = _rrf_weights(k, max(len(vector_results), len(keyword_results)))
 
-        # Adicionar scores da busca vetorial
-        for rank, (doc_id, _) in enumerate(vector_results):
-            scores[doc_id] += 1 / (k + rank + 1)
+        # Adicionar scores da busca vetorial (IDs únicos)
+        scores = {doc_id: weight for (doc_id, _), weight in zip(vector_results, weights)}
 
         # Adicionar scores da busca por palavra-chave
-        for rank, (doc_id, _) in enumerate(keyword_results):
-            scores[doc_id] += 1 / (k + rank + 1)
+        for (doc_id, _), weight in zip(keyword_results, weights):
+            scores[doc_id] = scores.get(doc_id, 0.0) + weight
 
-        # Ordenar por score combinado
-        combined = sorted(scores.items(), key=lambda x: x[1], reverse=True)
-
-        # Normalizar scores
-        if combined:
-            max_score = max(score for _, score in combined)
-            combined = [(doc_id, score / max_score) for doc_id, score in combined]
-
-        return combined
+        return _top_normalized(scores, top_k)
 
     def hybrid_search(self, query: str, top_k: int = 5,
                       document_id: Optional[str] = None,
@@ -193,7 +694,18 @@ class RAGService:
 
         Se use_rrf=True, usa Reciprocal Rank Fusion
         Se use_rrf=False, usa ponderação linear
+
+        Resultados ficam em cache (LRU com TTL) até o documento ser alterado
         """
+        cache_key = (document_id, hashlib.sha1(query.encode("utf-8")).hexdigest(), top_k, use_rrf)
+
+        with self._search_cache_lock:
+            cached = self._search_cache.get(cache_key)
+            if cached and time.monotonic() - cached[0] < settings.cache_ttl:
+                self._search_cache.move_to_end(cache_key)
+                return _copy_results(cached[1])
+            generation = self._generations.get(document_id, 0)
+
         # Busca vetorial
         vector_results = self.vector_search(query, top_k=top_k * 2, document_id=document_id)
 
@@ -202,99 +714,203 @@ class RAGService:
 
         if use_rrf:
             # Usar RRF para combinar resultados
-            combined = self.reciprocal_rank_fusion(vector_results, keyword_results, k=settings.rrf_k)
+            combined = self.reciprocal_rank_fusion(vector_results, keyword_results,
+                                                   k=settings.rrf_k, top_k=top_k)
         else:
             # Usar ponderação linear
-            combined = self._linear_fusion(vector_results, keyword_results)
+            combined = self._linear_fusion(vector_results, keyword_results, top_k=top_k)
 
-        # Pegar top_k resultados e recuperar metadados
+        # Recuperar metadados dos top_k resultados
         final_results = []
-        
-        for doc_id, score in combined[:top_k]:
-            if doc_id in self.documents_metadata:
-                data = self.documents_metadata[doc_id]
-                final_results.append({
-                    "id": doc_id,
-                    "text": data["text"],
-                    "metadata": data["metadata"],
-                    "score": score
-                })
-
-        return final_results
+
+        with self._rows_lock.read():
+            for doc_id, score in combined:
+                row = self._chunk_rows.get(doc_id)
+                if row is not None:
+                    final_results.append({
+                        "id": doc_id,
+                        "text": self._texts[row],
+                        "metadata": self._chunk_metadata(row),
+                        "score": score
+                    })
+
+        with self._search_cache_lock:
+            # Índice alterado durante a busca: o resultado pode não ter o lote mais recente
+            if self._generations.get(document_id, 0) == generation:
+                self._search_cache[cache_key] = (time.monotonic(), final_results)
+                self._search_cache.move_to_end(cache_key)
+                while len(self._search_cache) > SEARCH_CACHE_SIZE:
+                    self._search_cache.popitem(last=False)
+
+        return _copy_results(final_results)
+
+    def _bump_generation(self, document_id: str):
+        """Registra uma alteração do documento (e do índice como um todo); chamado sob _rows_lock.write()"""
+        with self._search_cache_lock:
+            for key in (document_id, None):
+                self._generations[key] = self._generations.get(key, 0) + 1
+
+    def _invalidate_search_cache(self, document_id: str):
+        """Remove do cache as buscas afetadas por alterações em um documento"""
+        with self._search_cache_lock:
+            for key in [k for k in self._search_cache if k[0] in (document_id, None)]:
+                del self._search_cache[key]
 
     def _linear_fusion(self, vector_results: List[Tuple[str, float]],
-                       keyword_results: List[Tuple[str, float]]) -> List[Tuple[str, float]]:
+                       keyword_results: List[Tuple[str, float]],
+                       top_k: Optional[int] = None) -> List[Tuple[str, float]]:
         """Combina resultados usando ponderação linear"""
-        combined_scores = defaultdict(float)
+        vector_weight = settings.hybrid_weight_vector
+        keyword_weight = settings.hybrid_weight_keyword
 
-        # Adicionar scores ponderados
-        for doc_id, score in vector_results:
-            combined_scores[doc_id] += score * settings.hybrid_weight_vector
+        # Adicionar scores ponderados (IDs únicos na busca vetorial)
+        scores = {doc_id: score * vector_weight for doc_id, score in vector_results}
 
         for doc_id, score in keyword_results:
-            combined_scores[doc_id] += score * settings.hybrid_weight_keyword
-
-        # Ordenar por score combinado
-        combined = sorted(combined_scores.items(), key=lambda x: x[1], reverse=True)
+            scores[doc_id] = scores.get(doc_id, 0.0) + score * keyword_weight
 
-        # Normalizar scores
-        if combined:
-            max_score = max(score for _, score in combined)
-            combined = [(doc_id, score / max_score) for doc_id, score in combined]
-
-        return combined
+        return _top_normalized(scores, top_k)
 
     def get_document_chunks(self, document_id: str) -> List[Dict[str, Any]]:
         """Recupera todos os chunks de um documento"""
         if not self.initialized:
             self.initialize()
 
-        chunks = []
-        for doc_id, data in self.documents_metadata.items():
-            if doc_id.startswith(document_id) and data["metadata"]["document_id"] == document_id:
-                chunks.append({
-                    "id": doc_id,
-                    "text": data["text"],
-                    "metadata": data["metadata"]
-                })
-
-        return chunks
+        with self._rows_lock.read():
+            return [
+                {
+                    "id": self.doc_ids_list[row],
+                    "text": self._texts[row],
+                    "metadata": self._chunk_metadata(row)
+                }
+                for row in self._document_rows.get(document_id, [])
+            ]
+
+    def _chunk_metadata(self, row: int) -> Dict[str, Any]:
+        """Monta o dict de metadados de um chunk a partir dos arrays por linha"""
+        return {
+            "document_id": self._row_documents[row],
+            "page": int(self._pages[row]),
+            "chunk_index": int(self._chunk_indexes[row]),
+            "text_length": int(self._text_lengths[row]),
+            **self._extra_metadata.get(row, {})
+        }
 
     def delete_document(self, document_id: str):
         """Remove todos os chunks de um documento do índice"""
+        self.delete_documents([document_id])
+
+    def delete_documents(self, document_ids: List[str]):
+        """Remove todos os chunks de vários documentos do índice em uma única passada"""
         if not self.initialized:
             self.initialize()
 
-        # Recuperar IDs do documento
-        doc_ids = [doc_id for doc_id in self.doc_ids_list if doc_id.startswith(document_id)]
-        
-        if doc_ids:
-            # FAISS não suporta deleção incremental facilmente
-            # Para simplificar, vamos recriar o índice sem esses documentos
-            # Na produção, considerar usar um índice incremental ou FAISS IndexIVF
-            
-            # Remover metadados
-            for doc_id in doc_ids:
-                if doc_id in self.documents_metadata:
-                    del self.documents_metadata[doc_id]
-                if doc_id in self.doc_ids_list:
-                    self.doc_ids_list.remove(doc_id)
-
-            print(f"Removidos {len(doc_ids)} chunks do documento {document_id} (índice será reconstruído no próximo initialize)")
-            # Nota: O índice FAISS não pode ser modificado facilmente sem reconstrução
-            # Para produção, considerar armazenar embeddings e reconstruir índice
+        with self._write_lock:
+            with self._rows_lock.write():
+                # Linhas do índice que pertencem aos documentos removidos
+                removed_rows = [row for document_id in document_ids
+                                for row in self._document_rows.pop(document_id, [])]
+
+                # Marcar as linhas como removidas; as buscas passam a descartá-las
+                for row in removed_rows:
+                    doc_id = self.doc_ids_list[row]
+                    if self._chunk_rows.get(doc_id) == row:
+                        del self._chunk_rows[doc_id]
+                    self._extra_metadata.pop(row, None)
+
+                self._alive[removed_rows] = False
+                self._n_dead += len(removed_rows)
+                for document_id in document_ids:
+                    self._bump_generation(document_id)
+
+            for document_id in document_ids:
+                self._invalidate_search_cache(document_id)
+
+            if not removed_rows:
+                return
+
+            print(f"Removidos {len(removed_rows)} chunks de {len(document_ids)} documento(s)")
+
+            # Muitas linhas mortas: compactar (já fora das requisições, na fila de indexação)
+            if self._n_dead > COMPACT_DEAD_FRACTION * self._n_vectors:
+                self._compact()
+
+    def _compact(self):
+        """
+        Descarta as linhas removidas e reconstrói o índice com os embeddings guardados
+
+        Chamado com _write_lock: o estado compactado é montado em variáveis
+        locais enquanto as buscas continuam no estado atual, e publicado de
+        uma vez sob _rows_lock.write().
+        """
+        keep = self._alive[:self._n_vectors].copy()
+        kept_rows = np.flatnonzero(keep)
+        new_rows = np.cumsum(keep) - 1
+
+        # Compactar as listas de chunks e renumerar as linhas
+        doc_ids_list = [self.doc_ids_list[row] for row in kept_rows]
+        texts = [self._texts[row] for row in kept_rows]
+        row_documents = [self._row_documents[row] for row in kept_rows]
+        extra_metadata = {int(new_rows[row]): metadata for row, metadata in self._extra_metadata.items()}
+        chunk_rows = {doc_id: int(new_rows[row]) for doc_id, row in self._chunk_rows.items()}
+        document_rows = {document_id: new_rows[rows].tolist()
+                         for document_id, rows in self._document_rows.items()}
+
+        # FAISS não remove vetores de forma incremental em todos os índices:
+        # reconstruir a partir dos embeddings guardados, sem recalculá-los
+        vectors = np.asarray(self._vectors[:self._n_vectors][keep])
+        capacity = max(len(vectors), MIN_VECTOR_CAPACITY)
+        pages, chunk_indexes, text_lengths = (
+            np.concatenate([array[:self._n_vectors][keep], np.zeros(capacity - len(vectors), dtype=np.int32)])
+            for array in (self._pages, self._chunk_indexes, self._text_lengths))
+        alive = np.zeros(capacity, dtype=bool)
+        alive[:len(vectors)] = True
+        vector_index = self._build_index(vectors)
+        term_matrix = self._keyword_matrix()[keep]
+        doc_lengths = self._doc_lengths[keep]
+
+        # Buscas em andamento continuam lendo o mapeamento do arquivo anterior
+        stored_vectors = self._new_vectors_file(vectors, capacity)
+
+        with self._rows_lock.write():
+            with self._keyword_lock:
+                self._term_matrix = term_matrix
+                self._doc_lengths = doc_lengths
+                self._doc_freq = np.diff(term_matrix.indptr).astype(np.int64)
+
+            self.doc_ids_list = doc_ids_list
+            self._texts = texts
+            self._row_documents = row_documents
+            self._extra_metadata = extra_metadata
+            self._chunk_rows = chunk_rows
+            self._document_rows = document_rows
+            self._pages, self._chunk_indexes, self._text_lengths = pages, chunk_indexes, text_lengths
+            self._vectors = stored_vectors
+            self._n_vectors = len(vectors)
+            self._alive = alive
+            self._n_dead = 0
+            self.vector_index = vector_index
+
+        print(f"Índice compactado: {len(vectors)} chunks")
 
     def get_index_stats(self) -> Dict[str, Any]:
         """Retorna estatísticas do índice"""
         if not self.initialized:
             self.initialize()
 
+        with self._rows_lock.read():
+            total_chunks = self.vector_index.ntotal - self._n_dead
+            index_type = ("IndexFlatIP (Inner Product)" if isinstance(self.vector_index, faiss.IndexFlat)
+                          else settings.vector_flat_index if self._is_exhaustive()
+                          else settings.vector_index_factory)
+
         return {
-            "total_chunks": self.vector_index.ntotal,
+            "total_chunks": total_chunks,
             "vector_store": "FAISS (Facebook AI Similarity Search)",
-            "index_type": "IndexFlatIP (Inner Product)",
+            "index_type": index_type,
             "model": settings.huggingface_model,
-            "device": settings.huggingface_device
+            "device": settings.huggingface_device,
+            "backend": settings.huggingface_backend
         }
 
 
@@ -5,16 +5,41 @@
 # ==========================================
 
 from typing import List, Dict, Any, Optional, Tuple
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
+from pathlib import Path
+import asyncio
+import os
+import threading
+import time
+import zipfile
 import numpy as np
-from sklearn.cluster import KMeans
-from sklearn.metrics.pairwise import cosine_similarity
+import faiss
+import orjson
 
-from sentence_transformers import SentenceTransformer
-from openai import OpenAI
+from openai import AsyncOpenAI
 
 from app.config import settings
 from app.models import DocumentMetadata
+from app.rag_service import rag_service
+
+
+# Chave do resumo de nível mais alto pré-calculado na árvore carregada
+TOP_SUMMARY_KEY = "_summary_top"
+
+# Chave dos embeddings normalizados de cada nível (float16, salvos à parte em .npz)
+EMBEDDINGS_KEY = "_embeddings"
+
+# Chave da matriz com os embeddings de todos os níveis (montada ao buscar na árvore)
+SEARCH_INDEX_KEY = "_search_index"
+
+# Iterações do K-Means usado para agrupar os chunks de cada nível
+KMEANS_ITERATIONS = 20
+
+# Máximo de resumos pedidos ao LLM ao mesmo tempo
+SUMMARY_CONCURRENCY = 8
+
+# Número máximo de árvores mantidas em cache (cada uma com seus embeddings)
+TREE_CACHE_SIZE = 64
 
 
 class RAPTORService:
@@ -26,8 +51,8 @@ class RAPTORService:
     """
 
     def __init__(self):
-        self.embeddings_model = None
-        self.llm_client = None
+        self._tree_cache = OrderedDict()  # doc_id -> (mtime, carregado_em, árvore)
+        self._tree_cache_lock = threading.Lock()
         self.initialized = False
 
     def initialize(self):
@@ -38,28 +63,21 @@ class RAPTORService:
         print(f"Inicializando RAPTOR Service...")
         print(f"  Embeddings model: {settings.huggingface_model}")
 
-        # Carregar modelo de embeddings
-        self.embeddings_model = SentenceTransformer(
-            settings.huggingface_model,
-            device=settings.huggingface_device
-        )
-
-        # Inicializar cliente OpenAI
-        if settings.openai_api_key:
-            self.llm_client = OpenAI(api_key=settings.openai_api_key)
-        else:
+        if not settings.openai_api_key:
             print("  AVISO: OPENAI_API_KEY não configurada. RAPTOR não funcionará.")
 
         self.initialized = True
         print("RAPTOR Service inicializado!")
 
-    def cluster_chunks(self, chunks: List[str], n_clusters: int) -> List[List[int]]:
+    def cluster_chunks(self, chunks: List[str], n_clusters: int,
+                       embeddings: Optional[np.ndarray] = None) -> List[List[int]]:
         """
         Agrupa chunks semelhantes usando K-Means
 
         Args:
             chunks: Lista de textos
             n_clusters: Número de clusters
+            embeddings: Embeddings já calculados dos chunks (opcional)
 
         Returns:
             Lista de listas, cada uma contendo os índices dos chunks do cluster
@@ -71,12 +89,18 @@ class RAPTORService:
             # Se tem menos chunks que clusters, retorna cada chunk como um cluster
             return [[i] for i in range(len(chunks))]
 
-        # Gerar embeddings
-        embeddings = self.embeddings_model.encode(chunks, convert_to_numpy=True)
+        # Gerar embeddings (mesmo modelo e lotes do RAG)
+        if embeddings is None:
+            embeddings = rag_service.embed_batch(chunks)
 
-        # Aplicar K-Means
-        kmeans = KMeans(n_clusters=n_clusters, random_state=42, n_init=10)
-        cluster_labels = kmeans.fit_predict(embeddings)
+        # Aplicar K-Means (FAISS, uma única execução; poucos pontos por centroide
+        # é o esperado aqui, então o aviso do FAISS fica desligado)
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        kmeans = faiss.Kmeans(embeddings.shape[1], n_clusters, niter=KMEANS_ITERATIONS, nredo=1,
+                              seed=42, min_points_per_centroid=1)
+        kmeans.train(embeddings)
+        _, cluster_labels = kmeans.index.search(embeddings, 1)
+        cluster_labels = cluster_labels[:, 0]
 
         # Organizar chunks por cluster
         clusters = defaultdict(list)
@@ -96,10 +120,33 @@ class RAPTORService:
         Returns:
             Resumo gerado pelo LLM
         """
-        if not self.initialized or not self.llm_client:
+        return self.summarize_chunk_groups([chunks], context)[0]
+
+    def summarize_chunk_groups(self, groups: List[List[str]], context: str = "") -> List[str]:
+        """
+        Gera os resumos de vários grupos de chunks com requisições simultâneas
+        ao LLM (até SUMMARY_CONCURRENCY por vez)
+
+        Não pode ser chamado de dentro de um event loop (roda o seu próprio).
+        """
+        if not self.initialized or not settings.openai_api_key:
             # Se não tem LLM, concatena chunks simplesmente
-            return " ".join(chunks[:3])
+            return [" ".join(chunks[:3]) for chunks in groups]
 
+        return asyncio.run(self._summarize_groups(groups, context))
+
+    async def _summarize_groups(self, groups: List[List[str]], context: str) -> List[str]:
+        semaphore = asyncio.Semaphore(SUMMARY_CONCURRENCY)
+
+        # Um cliente por execução: as conexões ficam presas ao event loop que as criou
+        async with AsyncOpenAI(api_key=settings.openai_api_key) as client:
+            return list(await asyncio.gather(
+                *(self._summarize_async(client, semaphore, chunks, context) for chunks in groups)
+            ))
+
+    async def _summarize_async(self, client: AsyncOpenAI, semaphore: asyncio.Semaphore,
+                               chunks: List[str], context: str = "") -> str:
+        """Gera o resumo de um grupo de chunks (versão assíncrona)"""
         # Concatenar chunks
         combined_text = "\n\n".join([f"Chunk {i+1}: {chunk}" for i, chunk in enumerate(chunks)])
 
@@ -114,15 +161,16 @@ Abaixo estão trechos de um documento que devem ser resumidos em um único pará
 RESUMO:"""
 
         try:
-            response = self.llm_client.chat.completions.create(
-                model=settings.openai_model,
-                messages=[
-                    {"role": "system", "content": "Você é um assistente especializado em resumir documentos de forma clara e concisa."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.3,
-                max_tokens=500
-            )
+            async with semaphore:
+                response = await client.chat.completions.create(
+                    model=settings.openai_model,
+                    messages=[
+                        {"role": "system", "content": "Você é um assistente especializado em resumir documentos de forma clara e concisa."},
+                        {"role": "user", "content": prompt}
+                    ],
+                    temperature=0.3,
+                    max_tokens=500
+                )
 
             return response.choices[0].message.content.strip()
 
@@ -161,6 +209,8 @@ RESUMO:"""
 
         # Construir níveis hierárquicos
         current_chunks = chunks
+        current_embeddings = rag_service.embed_batch(chunks)
+        level_embeddings = {"level_0": current_embeddings}
         current_level = 1
 
         while current_level <= max_depth and len(current_chunks) >= min_chunks:
@@ -168,15 +218,16 @@ RESUMO:"""
             n_clusters = max(2, len(current_chunks) // min_chunks)
 
             # Agrupar chunks
-            clusters = self.cluster_chunks(current_chunks, n_clusters)
+            clusters = self.cluster_chunks(current_chunks, n_clusters, embeddings=current_embeddings)
             tree["clusters"][f"level_{current_level}"] = clusters
 
-            # Gerar resumos para cada cluster
-            summaries = {}
-            for cluster_idx, cluster_indices in enumerate(clusters):
-                cluster_chunks = [current_chunks[i] for i in cluster_indices]
-                summary = self.summarize_chunk_group(cluster_chunks)
+            # Gerar resumos de todos os clusters do nível de uma vez
+            cluster_summaries = self.summarize_chunk_groups(
+                [[current_chunks[i] for i in cluster_indices] for cluster_indices in clusters]
+            )
 
+            summaries = {}
+            for cluster_idx, (cluster_indices, summary) in enumerate(zip(clusters, cluster_summaries)):
                 summary_id = f"summary_level{current_level}_cluster{cluster_idx}"
                 summaries[summary_id] = summary
 
@@ -193,10 +244,16 @@ RESUMO:"""
 
             # Usar resumos como chunks para o próximo nível
             current_chunks = list(summaries.values())
+            current_embeddings = rag_service.embed_batch(current_chunks)
+            level_embeddings[f"level_{current_level}"] = current_embeddings
             current_level += 1
 
         tree["depth"] = current_level - 1
 
+        # Embeddings dos níveis ficam na árvore: a busca não recodifica os resumos
+        tree[EMBEDDINGS_KEY] = {level_key: embeddings.astype(np.float16)
+                                for level_key, embeddings in level_embeddings.items()}
+
         return tree
 
     def retrieve_from_raptor(self, tree: Dict[str, Any], query: str,
@@ -217,51 +274,71 @@ RESUMO:"""
         if not self.initialized:
             self.initialize()
 
-        # Determinar quais níveis buscar
-        if target_level is not None:
-            levels_to_search = [target_level]
-        else:
-            # Buscar em todos os níveis
-            levels_to_search = list(range(tree["depth"] + 1))
+        search_index = self._search_index(tree)
+        scores = search_index["embeddings"] @ rag_service.embed_query(query)
 
-        # Gerar embedding da query
-        query_embedding = self.embeddings_model.encode(query, convert_to_numpy=True)
+        # Nível alvo: descartar os demais
+        candidates = np.arange(len(scores))
+        if target_level is not None:
+            candidates = np.flatnonzero(search_index["levels"] == target_level)
+
+        if not len(candidates) or top_k <= 0:
+            return []
+
+        # Ordenar por relevância (só os top_k)
+        if len(candidates) > top_k:
+            candidates = candidates[np.argpartition(-scores[candidates], top_k - 1)[:top_k]]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+
+        return [
+            {
+                "id": search_index["ids"][i],
+                "text": search_index["texts"][i],
+                "level": int(search_index["levels"][i]),
+                "score": float(scores[i]),
+                "type": "summary" if search_index["levels"][i] > 0 else "chunk"
+            }
+            for i in candidates
+        ]
+
+    def _search_index(self, tree: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Embeddings de todos os níveis empilhados em uma única matriz (com IDs,
+        textos e nível de cada linha), montados uma vez por árvore carregada
+        """
+        search_index = tree.get(SEARCH_INDEX_KEY)
+        if search_index is not None:
+            return search_index
 
-        # Buscar em cada nível
-        all_results = []
+        tree_embeddings = tree.get(EMBEDDINGS_KEY, {})
+        ids, texts, levels, blocks = [], [], [], []
 
-        for level in levels_to_search:
+        for level in range(tree["depth"] + 1):
             level_key = f"level_{level}"
             if level_key not in tree["summaries"]:
                 continue
 
             level_summaries = tree["summaries"][level_key]
+            ids.extend(level_summaries.keys())
+            texts.extend(level_summaries.values())
+            levels.extend([level] * len(level_summaries))
+
+            # Árvores antigas (sem embeddings salvos) recodificam os resumos
+            level_embeddings = tree_embeddings.get(level_key)
+            if level_embeddings is None:
+                level_embeddings = rag_service.embed_batch(list(level_summaries.values()))
+            blocks.append(level_embeddings)
+
+        search_index = {
+            "embeddings": (np.vstack(blocks).astype(np.float32) if blocks
+                           else np.empty((0, rag_service.embedding_dim), dtype=np.float32)),
+            "ids": ids,
+            "texts": texts,
+            "levels": np.array(levels, dtype=np.int16)
+        }
+        tree[SEARCH_INDEX_KEY] = search_index
 
-            # Gerar embeddings
-            summary_ids = list(level_summaries.keys())
-            summary_texts = list(level_summaries.values())
-            embeddings = self.embeddings_model.encode(summary_texts, convert_to_numpy=True)
-
-            # Calcular similaridade
-            similarities = cosine_similarity(
-                query_embedding.reshape(1, -1),
-                embeddings
-            )[0]
-
-            # Adicionar resultados
-            for i, (summary_id, similarity) in enumerate(zip(summary_ids, similarities)):
-                all_results.append({
-                    "id": summary_id,
-                    "text": summary_texts[i],
-                    "level": level,
-                    "score": float(similarity),
-                    "type": "summary" if level > 0 else "chunk"
-                })
-
-        # Ordenar por relevância
-        all_results.sort(key=lambda x: x["score"], reverse=True)
-
-        return all_results[:top_k]
+        return search_index
 
     def get_raptor_summary(self, tree: Dict[str, Any], level: int = -1) -> str:
         """
@@ -275,6 +352,9 @@ RESUMO:"""
             Resumo do nível especificado
         """
         if level == -1:
+            if TOP_SUMMARY_KEY in tree:
+                return tree[TOP_SUMMARY_KEY]
+
             level = tree["depth"]
 
         level_key = f"level_{level}"
@@ -293,28 +373,110 @@ RESUMO:"""
         else:
             return list(summaries.values())[0]
 
+    def get_tree_path(self, document_id: str) -> Path:
+        """Caminho do arquivo da árvore RAPTOR de um documento"""
+        return settings.indexes_path / f"raptor_{document_id}.json"
+
+    def get_embeddings_path(self, document_id: str) -> Path:
+        """Caminho do arquivo com os embeddings dos níveis da árvore RAPTOR"""
+        return settings.indexes_path / f"raptor_{document_id}.npz"
+
     def save_raptor_tree(self, tree: Dict[str, Any], document_id: str):
-        """Salva a árvore RAPTOR em disco"""
-        import json
-        from pathlib import Path
+        """Salva a árvore RAPTOR em disco (embeddings em um .npz ao lado do JSON)"""
+        tree_path = self.get_tree_path(document_id)
+
+        # Embeddings antes do JSON: quem vê a árvore nova já encontra os embeddings
+        embeddings_path = self.get_embeddings_path(document_id)
+        if EMBEDDINGS_KEY in tree:
+            tmp_path = embeddings_path.with_name(embeddings_path.name + ".tmp")
+            with open(tmp_path, "wb") as f:
+                np.savez(f, **tree[EMBEDDINGS_KEY])
+            os.replace(tmp_path, embeddings_path)
+        else:
+            embeddings_path.unlink(missing_ok=True)
+
+        # Chaves com "_" são derivadas (embeddings, resumo e índice de busca)
+        data = orjson.dumps({key: value for key, value in tree.items() if not key.startswith("_")})
 
-        tree_path = settings.indexes_path / f"raptor_{document_id}.json"
+        # Escrita atômica: quem carrega a árvore nunca vê um arquivo pela metade
+        tmp_path = tree_path.with_name(tree_path.name + ".tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, tree_path)
 
-        with open(tree_path, "w", encoding="utf-8") as f:
-            json.dump(tree, f, ensure_ascii=False, indent=2)
+        self.invalidate_document(document_id)
+
+    def invalidate_document(self, document_id: str):
+        """Remove do cache a árvore de um documento (alterado ou removido)"""
+        with self._tree_cache_lock:
+            self._tree_cache.pop(document_id, None)
 
     def load_raptor_tree(self, document_id: str) -> Optional[Dict[str, Any]]:
-        """Carrega a árvore RAPTOR do disco"""
-        import json
-        from pathlib import Path
+        """
+        Carrega a árvore RAPTOR do disco
 
-        tree_path = settings.indexes_path / f"raptor_{document_id}.json"
+        A árvore fica em cache (LRU, até TREE_CACHE_SIZE árvores) por até
+        `cache_ttl` segundos e é recarregada se o arquivo for modificado.
+        """
+        tree_path = self.get_tree_path(document_id)
 
-        if not tree_path.exists():
+        try:
+            mtime = tree_path.stat().st_mtime
+        except FileNotFoundError:
+            self.invalidate_document(document_id)
             return None
 
-        with open(tree_path, "r", encoding="utf-8") as f:
-            return json.load(f)
+        now = time.monotonic()
+
+        with self._tree_cache_lock:
+            cached = self._tree_cache.get(document_id)
+            if cached and cached[0] == mtime and now - cached[1] < settings.cache_ttl:
+                self._tree_cache.move_to_end(document_id)
+                return cached[2]
+
+        tree = orjson.loads(tree_path.read_bytes())
+
+        # Pré-calcular o resumo do nível mais alto (usado em todo chat)
+        tree[TOP_SUMMARY_KEY] = self.get_raptor_summary(tree, level=-1)
+
+        tree[EMBEDDINGS_KEY] = self._load_embeddings(tree, document_id)
+
+        with self._tree_cache_lock:
+            self._tree_cache[document_id] = (mtime, now, tree)
+            self._tree_cache.move_to_end(document_id)
+            while len(self._tree_cache) > TREE_CACHE_SIZE:
+                self._tree_cache.popitem(last=False)
+
+        return tree
+
+    def _load_embeddings(self, tree: Dict[str, Any], document_id: str) -> Dict[str, np.ndarray]:
+        """
+        Carrega os embeddings salvos dos níveis da árvore
+
+        Só são aceitos níveis com uma linha por resumo; os demais (arquivo
+        ausente, corrompido ou de outra versão da árvore) são recodificados
+        ao buscar na árvore.
+        """
+        try:
+            with np.load(self.get_embeddings_path(document_id)) as embeddings:
+                saved = {level_key: embeddings[level_key] for level_key in embeddings.files}
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+            print(f"Embeddings RAPTOR inválidos para {document_id}, serão recalculados: {e}")
+            return {}
+
+        valid = {}
+        for level_key, level_embeddings in saved.items():
+            level_summaries = tree["summaries"].get(level_key)
+            if (level_summaries is not None and level_embeddings.ndim == 2
+                    and level_embeddings.shape[0] == len(level_summaries)
+                    and (not rag_service.embedding_dim or level_embeddings.shape[1] == rag_service.embedding_dim)):
+                valid[level_key] = level_embeddings
+
+        if len(valid) < len(saved) or len(valid) < len(tree["summaries"]):
+            print(f"Embeddings RAPTOR de {document_id} incompletos, níveis faltantes serão recalculados")
+
+        return valid
 
     def build_and_index_document(self, chunks: List[str], document_id: str) -> Dict[str, Any]:
         """
@@ -0,0 +1,155 @@
+# ==========================================
+# PDF Consultor - Indexing Queue
+# ==========================================
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+from app.pdf_processor import PDFProcessor
+from app.rag_service import rag_service
+from app.raptor_service import raptor_service
+from app.persistence import persistence
+from app.chat_service import chat_service
+
+
+logger = logging.getLogger(__name__)
+
+# Estados de uma tarefa na fila
+STATUS_PENDING = "pending"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+
+def index_document(document_id: str, pdf_path: Path) -> int:
+    """Indexa um documento (texto, RAG e RAPTOR) e retorna o número de chunks"""
+    logger.info("Indexando documento %s...", document_id)
+
+    processor = PDFProcessor()
+
+    # PDF digitalizado (sem texto selecionável): usar OCR
+    if processor.is_scanned(pdf_path):
+        logger.info("Documento %s parece digitalizado, aplicando OCR", document_id)
+        batches = iter([processor.ocr_pages(pdf_path)])
+    else:
+        batches = processor.iter_text_with_layout_parallel(pdf_path)
+
+    # Gerar embeddings de cada faixa de páginas enquanto as seguintes
+    # ainda estão sendo extraídas pelos outros processos
+    chunks = []
+    for text_by_page in batches:
+        batch = [
+            {"text": text, "page": page_num}
+            for page_num, text in text_by_page.items()
+            if text.strip()
+        ]
+
+        if batch:
+            rag_service.add_documents(batch, document_id, start_index=len(chunks))
+            chunks.extend(batch)
+
+    # Construir RAPTOR
+    chunk_texts = [chunk["text"] for chunk in chunks]
+    raptor_service.build_and_index_document(chunk_texts, document_id)
+
+    # Marcar como indexado
+    persistence.set_document_indexed(document_id, len(chunks))
+
+    # Respostas geradas com o índice anterior deixam de valer
+    chat_service.invalidate_document(document_id)
+
+    logger.info("Documento %s indexado com %d chunks", document_id, len(chunks))
+
+    return len(chunks)
+
+
+def delete_document_index(document_ids: List[str]) -> None:
+    """Remove documentos do índice RAG"""
+    rag_service.delete_documents(document_ids)
+
+    for document_id in document_ids:
+        chat_service.invalidate_document(document_id)
+
+
+class IndexingQueue:
+    """
+    Fila de tarefas pesadas de indexação
+
+    Executa as tarefas fora dos handlers de requisição, uma de cada vez:
+    o índice FAISS e os metadados do RAG ficam em memória neste processo
+    e não são seguros para escrita concorrente.
+    """
+
+    def __init__(self, max_workers: int = 1):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix="indexer")
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def enqueue_index(self, document_id: str, pdf_path: Path) -> Dict[str, Any]:
+        """Agenda a indexação de um documento"""
+        return self._submit("index", [document_id], index_document, document_id, pdf_path)
+
+    def enqueue_delete(self, document_ids: List[str]) -> Dict[str, Any]:
+        """Agenda a remoção de documentos do índice RAG (uma única tarefa)"""
+        return self._submit("delete", document_ids, delete_document_index, document_ids)
+
+    def get_status(self, document_id: str) -> Optional[Dict[str, Any]]:
+        """Retorna uma cópia do estado da última tarefa do documento"""
+        with self._lock:
+            job = self._jobs.get(document_id)
+            return dict(job) if job else None
+
+    def shutdown(self) -> None:
+        """Encerra a fila descartando tarefas que ainda não começaram"""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _submit(self, task: str, document_ids: List[str], func: Callable, *args) -> Dict[str, Any]:
+        with self._lock:
+            job = self._jobs.get(document_ids[0])
+
+            # Mesma tarefa já na fila: não duplicar o trabalho
+            if (job and job["task"] == task and job["status"] == STATUS_PENDING
+                    and all(self._jobs.get(doc_id) is job for doc_id in document_ids)):
+                return dict(job)
+
+            job = {
+                "task": task,
+                "status": STATUS_PENDING,
+                "submitted_at": datetime.now(),
+                "finished_at": None,
+                "result": None,
+                "error": None,
+            }
+            for doc_id in document_ids:
+                self._jobs[doc_id] = job
+
+        self._executor.submit(self._run, job, func, *args)
+        return dict(job)
+
+    def _run(self, job: Dict[str, Any], func: Callable, *args) -> None:
+        with self._lock:
+            job["status"] = STATUS_RUNNING
+
+        try:
+            result = func(*args)
+        except Exception as e:
+            logger.exception("Falha na tarefa %s de %s", job["task"], args[0])
+            with self._lock:
+                job["status"] = STATUS_FAILED
+                job["error"] = str(e)
+                job["finished_at"] = datetime.now()
+            return
+
+        with self._lock:
+            job["status"] = STATUS_DONE
+            job["result"] = result
+            job["finished_at"] = datetime.now()
+
+
+# Instância global da fila de indexação
+indexing_queue = IndexingQueue()
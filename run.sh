@@ -28,5 +28,5 @@ echo "Pressione Ctrl+C para parar."
 echo "========================================="
 echo ""
 
-# Iniciar com uvicorn
-uvicorn app.main:app --host 0.0.0.0 --port 8000 --reload
+# Iniciar com uvicorn (use --reload apenas durante o desenvolvimento)
+uvicorn app.main:app --host 0.0.0.0 --port 8000 --loop uvloop --http httptools
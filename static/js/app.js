@@ -401,6 +401,8 @@ async function uploadDocument() {
 
             // Reload documents
             loadDocuments();
+        } else if (response.status === 409) {
+            showNotification('Este PDF já foi enviado anteriormente', 'error');
         } else {
             throw new Error('Upload falhou');
         }